@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import subprocess
+
+# Нагрузочный тест бота без сети: для каждого размера каталога генерируется
+# синтетическая база, апдейты подаются через dp.feed_update, а запросы к
+# Bot API обрабатывает заглушка сессии. Каждый размер запускается в отдельном
+# процессе, потому что настройки бота читаются из окружения при импорте.
+#
+#   python benchmark.py --sizes 1000,10000,100000 --output benchmark.json
+#   python benchmark.py --engine fts --compare benchmark.json
+
+ADMIN_ID = 376742720
+SCENARIOS = ("search", "random", "selection", "admin_insert")
+
+CYRILLIC_FIRST = ["Человек", "Капитан", "Доктор", "Тёмный", "Железный", "Алый", "Ночной", "Серебряный",
+                  "Громовой", "Призрачный", "Стальной", "Бледный"]
+CYRILLIC_SECOND = ["паук", "молот", "ворон", "сокол", "страж", "призрак", "рыцарь", "шторм", "клинок",
+                   "волк", "феникс", "мститель"]
+CYRILLIC_SYLLABLES = ["кра", "зо", "ми", "тар", "лин", "вос", "дэ", "ру", "ган", "ше", "ко", "ла"]
+LATIN_FIRST = ["Captain", "Doctor", "Dark", "Iron", "Scarlet", "Night", "Silver", "Thunder", "Ghost",
+               "Steel", "Pale", "Black"]
+LATIN_SECOND = ["Spider", "Hammer", "Raven", "Falcon", "Guardian", "Phantom", "Knight", "Storm", "Blade",
+                "Wolf", "Phoenix", "Avenger"]
+LATIN_SYLLABLES = ["kra", "zo", "mi", "tar", "lin", "vos", "de", "ru", "gan", "she", "ko", "la"]
+PUBLISHERS = ["Marvel", "DC", "Image", "Dark Horse", "Bubble", "IDW"]
+UNIVERSES = ["Земля-616", "Ultimate", "Marvel Noir", "Prime Earth", "Elseworlds", "Bubble Universe"]
+TYPES = ["Герой", "Злодей", "Антигерой"]
+DESCRIPTION_WORDS = ["мрачный", "мститель", "город", "ночью", "сила", "тайна", "прошлое", "команда",
+                     "hero", "villain", "secret", "city", "power", "legacy", "multiverse", "armor"]
+
+# Синтетический персонаж: половина имён кириллицей, половина латиницей
+def generate_row(rng):
+    if rng.random() < 0.5:
+        first, second, syllables = CYRILLIC_FIRST, CYRILLIC_SECOND, CYRILLIC_SYLLABLES
+    else:
+        first, second, syllables = LATIN_FIRST, LATIN_SECOND, LATIN_SYLLABLES
+    suffix = "".join(rng.choice(syllables) for _ in range(rng.randint(2, 3))).capitalize()
+    name = f"{rng.choice(first)}-{rng.choice(second)} {suffix}"
+    description = " ".join(rng.choice(DESCRIPTION_WORDS) for _ in range(rng.randint(8, 15))).capitalize() + "."
+    return (name, rng.choice(PUBLISHERS), rng.choice(UNIVERSES), rng.choice(TYPES), description,
+            "https://t.me/komikshub/1", "https://example.com/art.jpg")
+
+# База в исходной схеме: миграции бот применит сам при открытии
+def generate_database(path, size, rng):
+    connection = sqlite3.connect(path)
+    connection.execute('''CREATE TABLE characters
+                          (name TEXT, publisher TEXT, universe TEXT, type TEXT, description TEXT, post_link TEXT, art_link TEXT)''')
+    rows = [generate_row(rng) for _ in range(size)]
+    connection.executemany("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    connection.commit()
+    connection.close()
+    return rows
+
+# Поисковый запрос: слово из имени, его начало, слово с опечаткой,
+# два слова или запрос без совпадений
+def generate_query(rng, rows):
+    words = rng.choice(rows)[0].replace("-", " ").split()
+    word = rng.choice(words)
+    kind = rng.random()
+    if kind < 0.3:
+        return word
+    if kind < 0.55:
+        return word[:rng.randint(4, 6)]
+    if kind < 0.8:
+        position = rng.randrange(len(word))
+        return word[:position] + rng.choice("аоеиxyz") + word[position + 1:]
+    if kind < 0.9:
+        return " ".join(words[:2])
+    return "".join(rng.choice("йцукенqwerty") for _ in range(7))
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+# Один размер каталога в текущем процессе; печатает результат в stdout
+async def run_size(args):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message, Update
+    import komikshub_bot as k
+
+    k.setup_logging()
+
+    # Заглушка Bot API: каждый запрос «выполняется» за api_latency секунд
+    class StubSession(BaseSession):
+        def __init__(self, latency):
+            super().__init__()
+            self.latency = latency
+            self.requests = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            chat_id = getattr(method, "chat_id", None)
+            if chat_id is None:
+                return True
+            return Message(message_id=self.requests, date=datetime.datetime.now(),
+                           chat=Chat(id=chat_id, type="private"), text=getattr(method, "text", None))
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+    session = StubSession(args.api_latency / 1000)
+    session.middleware = k.bot.session.middleware  # планировщик отправок и метрики остаются в цепочке
+    k.bot.session = session
+    rng = random.Random(args.seed)
+
+    started = time.perf_counter()
+    rows = generate_database(k.database_file, args.child_size, rng)
+    generated = time.perf_counter()
+    await k.prepare_database()
+    k.use_fallback_search()
+    opened = time.perf_counter()
+    k.catalog.load(await k.db.all_characters())
+    loaded = time.perf_counter()
+    ids = list(k.catalog.rows)
+
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "Bench"}
+
+    def message(update_id, chat_id, user_id, text):
+        data = {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"},
+                "from": user(user_id), "text": text}
+        if text.startswith("/"):
+            data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.model_validate({"update_id": update_id, "message": data})
+
+    def callback(update_id, chat_id, data):
+        return Update.model_validate({"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user(chat_id), "chat_instance": "bench", "data": data,
+            "message": {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "-"}}})
+
+    # Готовит апдейты сценария (и состояние FSM для них) до начала замера.
+    # У каждой операции свой чат, поэтому состояния не пересекаются.
+    async def prepare(name, count, offset):
+        updates = []
+        for i in range(count):
+            chat_id = offset + i
+            if name == "search":
+                await k.dp.fsm.get_context(k.bot, chat_id, chat_id).set_state(k.SearchStates.waiting_for_query)
+                updates.append(message(chat_id, chat_id, chat_id, generate_query(rng, rows)))
+            elif name == "random":
+                text = "/random" if rng.random() < 0.5 else f"/random {rng.choice(PUBLISHERS + TYPES)}"
+                updates.append(message(chat_id, chat_id, chat_id, text))
+            elif name == "selection":
+                updates.append(callback(chat_id, chat_id, f"sel:{rng.choice(ids)}"))
+            else:
+                row = generate_row(rng)
+                context = k.dp.fsm.get_context(k.bot, chat_id, ADMIN_ID)
+                await context.set_state(k.AddCharacterStates.waiting_for_art_link)
+                await context.update_data(name=row[0], publisher=row[1], universe=row[2], type=row[3],
+                                          description=row[4], post_link=row[5])
+                updates.append(message(chat_id, chat_id, ADMIN_ID, row[6]))
+        return updates
+
+    async def measure(updates):
+        latencies = []
+        errors = 0
+        pending = iter(updates)
+
+        async def worker():
+            nonlocal errors
+            for update in pending:
+                begin = time.perf_counter()
+                try:
+                    await k.dp.feed_update(k.bot, update)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        return latencies, errors, time.perf_counter() - begin
+
+    scenarios = {}
+    offset = 10_000_000
+    for name in args.scenarios:
+        await measure(await prepare(name, args.warmup, offset))
+        offset += args.warmup
+        updates = await prepare(name, args.requests, offset)
+        offset += args.requests
+        requests_before = session.requests
+        latencies, errors, wall = await measure(updates)
+        latencies.sort()
+        scenarios[name] = {
+            "count": len(latencies),
+            "errors": errors,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3),
+            "throughput_per_s": round(len(latencies) / wall, 1),
+            "api_requests": session.requests - requests_before,
+        }
+
+    # Даём фоновым задачам (рассылка, запись FSM) завершиться
+    await asyncio.gather(*k.broadcast_tasks, return_exceptions=True)
+    await k.dp.storage.close()
+    k.send_scheduler.close()
+    k.scoring_executor.shutdown()
+    k.db.close()
+    return {
+        "size": args.child_size,
+        "engine": os.environ["SEARCH_ENGINE"],
+        "startup": {
+            "generate_seconds": round(generated - started, 3),
+            "open_seconds": round(opened - generated, 3),
+            "catalog_load_seconds": round(loaded - opened, 3),
+        },
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "scenarios": scenarios,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Сравнение с прошлым запуском: изменение p95 и пропускной способности
+def compare(previous, current):
+    before = {(result["size"], result["engine"], name): stats
+              for result in previous["results"] for name, stats in result["scenarios"].items()}
+    lines = []
+    for result in current["results"]:
+        for name, stats in result["scenarios"].items():
+            old = before.get((result["size"], result["engine"], name))
+            if old is None:
+                continue
+            p95 = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0.0
+            throughput = (stats["throughput_per_s"] - old["throughput_per_s"]) / old["throughput_per_s"] * 100
+            lines.append(f"{result['size']:>7} {name:<13} p95 {old['p95_ms']:>9.2f} -> {stats['p95_ms']:>9.2f} мс ({p95:+.1f}%)"
+                         f"  rps {old['throughput_per_s']:>8.1f} -> {stats['throughput_per_s']:>8.1f} ({throughput:+.1f}%)")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на синтетических каталогах")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры каталога через запятую")
+    parser.add_argument("--requests", type=int, default=500, help="операций на сценарий")
+    parser.add_argument("--warmup", type=int, default=20, help="операций прогрева на сценарий (не учитываются)")
+    parser.add_argument("--concurrency", type=int, default=10, help="одновременно обрабатываемых апдейтов")
+    parser.add_argument("--engine", choices=["fuzzy", "fts"], default="fuzzy", help="движок поиска (SEARCH_ENGINE)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="сценарии через запятую")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Bot API, мс")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark.json", help="файл с результатами в JSON")
+    parser.add_argument("--compare", help="JSON прошлого запуска для сравнения")
+    parser.add_argument("--child-size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    if args.child_size is not None:
+        json.dump(asyncio.run(run_size(args)), sys.stdout)
+        return
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory(prefix="komikshub-bench-") as workdir:
+            env = {
+                **os.environ,
+                "TELEGRAM_TOKEN": "123456:BENCHMARKbenchmarkBENCHMARKbenchmark",
+                "DATABASE_URL": "",
+                "DATABASE_FILE": os.path.join(workdir, "characters.db"),
+                "FSM_STORAGE_FILE": os.path.join(workdir, "fsm_state.db"),
+                "SEARCH_ENGINE": args.engine,
+                "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+                # Лимиты Telegram не измеряем: планировщик пропускает всё сразу
+                "SEND_RATE": "1000000",
+                "SEND_BURST": "1000000",
+                "SEND_CHAT_RATE": "1000000",
+                "SEND_CHAT_BURST": "1000000",
+            }
+            command = [sys.executable, os.path.abspath(__file__), "--child-size", str(size),
+                       "--requests", str(args.requests), "--warmup", str(args.warmup),
+                       "--concurrency", str(args.concurrency), "--engine", args.engine,
+                       "--scenarios", ",".join(args.scenarios), "--api-latency", str(args.api_latency),
+                       "--seed", str(args.seed)]
+            print(f"Каталог {size} персонажей...", file=sys.stderr)
+            completed = subprocess.run(command, env=env, stdout=subprocess.PIPE, check=True)
+            result = json.loads(completed.stdout)
+            results.append(result)
+            for name, stats in result["scenarios"].items():
+                print(f"{size:>7} {name:<13} p50 {stats['p50_ms']:>8.2f}  p95 {stats['p95_ms']:>8.2f}  "
+                      f"p99 {stats['p99_ms']:>8.2f} мс  {stats['throughput_per_s']:>8.1f} оп/с  ошибок {stats['errors']}",
+                      file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            for line in compare(json.load(f), report):
+                print(line, file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
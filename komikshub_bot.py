@@ -1,14 +1,432 @@
 import os
+import csv
+import time
+import logging
 import sqlite3
 import asyncio
-import requests
+import json
+import queue
+import hashlib
+import tempfile
+import shutil
+import bisect
+import random
+import secrets
+import contextvars
+import signal
+import multiprocessing
+import zlib
+import operator
+from array import array
+from itertools import compress, islice, repeat
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
 from aiohttp import web
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command, CommandStart
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from fuzzywuzzy import fuzz
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+import numpy
+from rapidfuzz import fuzz, process
+from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+# Логирование: уровень задаётся LOG_LEVEL, формат LOG_FORMAT (text или json),
+# а DEBUG-сообщения горячих путей прореживаются с долей LOG_DEBUG_SAMPLE_RATE
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        if self.as_json:
+            return json.dumps(fields, ensure_ascii=False, default=str)
+        return " ".join(f"{key}={value!r}" if key != "msg" else value for key, value in fields.items())
+
+class DebugSamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+def setup_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(as_json=os.getenv("LOG_FORMAT", "text") == "json"))
+    handler.addFilter(DebugSamplingFilter(float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 1.0))))
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[handler], force=True)
+
+logger = logging.getLogger("komikshub")
+
+# Ключевые поля записи (user_id, query, счётчики) попадают в вывод отдельными
+# ключами: logger.info("...", extra=log_fields(user_id=...))
+def log_fields(**values):
+    return {"fields": values}
+
+# Метрики в формате Prometheus: счётчики и гистограммы задержек с метками
+class Metrics:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix="komikshub"):
+        self.prefix = prefix
+        self.help = {}
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики корзин, сумма, количество]
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        buckets = histogram[0]
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    # Снимок значений в виде, пригодном для JSON
+    def dump(self):
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+            "histograms": [[name, labels, list(buckets), seconds, count]
+                           for (name, labels), (buckets, seconds, count) in self.histograms.items()],
+        }
+
+    # Новый объект Metrics: свои значения плюс снимки dump() других процессов
+    def merged(self, snapshots):
+        total = Metrics(self.prefix)
+        total.help = self.help
+        total.counters = dict(self.counters)
+        total.histograms = {key: [list(buckets), seconds, count] for key, (buckets, seconds, count) in self.histograms.items()}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                total.counters[key] = total.counters.get(key, 0) + value
+            for name, labels, buckets, seconds, count in snapshot["histograms"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                histogram = total.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += seconds
+                histogram[2] += count
+        return total
+
+    def render(self):
+        lines = []
+        by_name = {}
+        for (name, labels), value in self.counters.items():
+            by_name.setdefault(name, []).append(("counter", labels, value))
+        for (name, labels), value in self.histograms.items():
+            by_name.setdefault(name, []).append(("histogram", labels, value))
+        for name in sorted(by_name):
+            full_name = f"{self.prefix}_{name}"
+            kind, text = self.help.get(name, (by_name[name][0][0], name))
+            lines.append(f"# HELP {full_name} {text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for kind, labels, value in by_name[name]:
+                if kind == "counter":
+                    lines.append(f"{full_name}{self._labels(labels)} {value}")
+                    continue
+                buckets, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f"{full_name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{full_name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{full_name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{full_name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("update_seconds", "histogram", "Время обработки одного апдейта Telegram")
+metrics.describe("updates_total", "counter", "Обработанные апдейты по типу и результату")
+metrics.describe("db_seconds", "histogram", "Время запросов к SQLite")
+metrics.describe("search_seconds", "histogram", "Время этапов поиска")
+metrics.describe("search_candidates_total", "counter", "Тексты, оценённые нечётким поиском или найденные FTS")
+metrics.describe("search_rejected_total", "counter", "Поисковые запросы, отклонённые из-за переполнения очереди")
+metrics.describe("telegram_seconds", "histogram", "Время запросов к Telegram Bot API")
+metrics.describe("telegram_errors_total", "counter", "Ошибки запросов к Telegram Bot API")
+metrics.describe("send_wait_seconds", "histogram", "Ожидание отправки в очереди планировщика")
+metrics.describe("send_retries_total", "counter", "Повторы отправки после 429 Too Many Requests")
+metrics.describe("broadcast_messages_total", "counter", "Сообщения рассылки о новых персонажах по результату")
+
+# Middleware aiogram: время обработки и результат каждого входящего апдейта
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        update_type = getattr(event, "event_type", type(event).__name__)
+        status = "ok"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            metrics.observe("update_seconds", time.perf_counter() - started, type=update_type)
+            metrics.inc("updates_total", type=update_type, status=status)
+
+# Middleware сессии бота: время каждого исходящего запроса к Bot API
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        method_name = type(method).__name__
+        try:
+            with metrics.timer("telegram_seconds", method=method_name):
+                return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("telegram_errors_total", method=method_name, error=type(e).__name__)
+            raise
+
+# Ведро токенов: rate токенов в секунду, не больше capacity подряд.
+# Состояние (токены, время пополнения, скорость) лежит в общем массиве
+# state, поэтому одно и то же ведро видят все воркеры. Слот пополняется с
+# наименьшей скоростью из тех, кто брал из него токены с тех пор, как он
+# был полным: если в слот попали личный чат и группа, лимит группы не
+# ослабляется, а у личного чата он на это время строже.
+class TokenBucket:
+    SLOT_SIZE = 3
+
+    def __init__(self, state, slot, rate, capacity):
+        self.state = state
+        self.index = slot * self.SLOT_SIZE
+        self.rate = rate
+        self.capacity = capacity
+
+    # (токены, скорость пополнения слота)
+    def _refill(self, now):
+        tokens, updated, slot_rate = self.state[self.index:self.index + self.SLOT_SIZE]
+        rate = min(self.rate, slot_rate)
+        tokens = min(self.capacity, tokens + max(0.0, now - updated) * rate)
+        self.state[self.index], self.state[self.index + 1] = tokens, now
+        if tokens >= self.capacity:
+            # Полное ведро не помнит, кто из него брал
+            self.state[self.index + 2] = float("inf")
+        return tokens, rate
+
+    # Сколько секунд ждать, пока в ведре не станет 1 + reserve токенов
+    # (не больше capacity); 0 — можно отправлять
+    def delay(self, now, reserve=0):
+        tokens, rate = self._refill(now)
+        needed = max(1, min(1 + reserve, self.capacity))
+        return 0.0 if tokens >= needed else (needed - tokens) / rate
+
+    def take(self):
+        self.state[self.index] -= 1
+        self.state[self.index + 2] = min(self.state[self.index + 2], self.rate)
+
+    # Следующий токен появится не раньше чем через seconds (429 для этого чата)
+    def block(self, now, seconds):
+        tokens, rate = self._refill(now)
+        self.state[self.index] = min(tokens, 1.0) - seconds * rate
+        self.state[self.index + 2] = rate
+
+# Лимиты отправки, общие для всех воркеров: вёдра в разделяемой памяти
+# (слот 0 — общий лимит бота, остальные — чаты по crc32 от chat_id; при
+# коллизии два чата делят одно ведро с меньшей из их скоростей, см.
+# TokenBucket) и пауза после 429.
+# Создаются в родительском процессе и передаются воркерам при запуске.
+class SendLimits:
+    def __init__(self, slots=16384):
+        # Тот же контекст spawn, в котором run_workers запускает воркеров
+        context = multiprocessing.get_context("spawn")
+        self.slots = slots
+        self.lock = context.Lock()
+        self.buckets = context.RawArray("d", slots * TokenBucket.SLOT_SIZE)
+        # Время пополнения -inf: любое ведро при первом обращении полное;
+        # скорость inf: из слота ещё никто не брал
+        self.buckets[1::TokenBucket.SLOT_SIZE] = [float("-inf")] * slots
+        self.buckets[2::TokenBucket.SLOT_SIZE] = [float("inf")] * slots
+        self.paused_until = context.RawValue("d", 0.0)
+
+    def slot(self, chat_id):
+        return 1 + zlib.crc32(str(chat_id).encode()) % (self.slots - 1)
+
+# Планировщик исходящих сообщений: общее ведро на весь бот и ведро на каждый
+# чат (в группах лимит ниже), две очереди приоритета. Ответы пользователям
+# идут в HIGH, рассылка — в LOW и получает только свободные токены: в общем
+# ведре для неё остаётся LOW_RESERVE токенов на ответы из других воркеров.
+# Очередь разбирает одна фоновая задача, ожидающие получают разрешение через future.
+class SendScheduler:
+    HIGH, LOW = 0, 1
+    LANES = ("high", "low")
+    LOW_RESERVE = 1
+
+    def __init__(self, rate=25, burst=5, chat_rate=1.0, chat_burst=3, group_rate=20 / 60, limits=None):
+        self.rate = rate
+        self.burst = burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.use_limits(limits or SendLimits())
+        self.lanes = (deque(), deque())  # (chat_id, future)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    # Воркер подключается к лимитам, созданным родительским процессом
+    def use_limits(self, limits):
+        self.limits = limits
+        self.global_bucket = TokenBucket(limits.buckets, 0, self.rate, self.burst)
+
+    def _chat_bucket(self, chat_id):
+        group = isinstance(chat_id, str) or chat_id < 0
+        return TokenBucket(self.limits.buckets, self.limits.slot(chat_id),
+                           self.group_rate if group else self.chat_rate, self.chat_burst)
+
+    # Ждёт разрешения на отправку в чат chat_id
+    async def acquire(self, chat_id, priority=HIGH):
+        future = asyncio.get_running_loop().create_future()
+        self.lanes[priority].append((chat_id, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+        started = time.perf_counter()
+        await future
+        metrics.observe("send_wait_seconds", time.perf_counter() - started, lane=self.LANES[priority])
+
+    # Telegram вернул 429 для чата: этот чат ждёт retry_after во всех
+    # воркерах, остальные чаты отправляются как обычно
+    def backoff(self, chat_id, seconds):
+        with self.limits.lock:
+            self._chat_bucket(chat_id).block(time.monotonic(), seconds)
+        self.wakeup.set()
+
+    # Повторный 429: до конца retry_after не отправляет ни один воркер
+    def pause(self, seconds):
+        with self.limits.lock:
+            self.limits.paused_until.value = max(self.limits.paused_until.value, time.monotonic() + seconds)
+        self.wakeup.set()
+
+    # Выдаёт все разрешения, возможные сейчас; возвращает время до следующей
+    # попытки или None, если очередь пуста
+    def _dispatch(self, now):
+        with self.limits.lock:
+            paused_until = self.limits.paused_until.value
+            if now < paused_until:
+                return paused_until - now
+            wait = None
+            for priority, lane in enumerate(self.lanes):
+                reserve = self.LOW_RESERVE if priority == self.LOW else 0
+                index = 0
+                while index < len(lane):
+                    chat_id, future = lane[index]
+                    if future.done():
+                        del lane[index]
+                        continue
+                    global_delay = self.global_bucket.delay(now, reserve)
+                    if global_delay > 0:
+                        return global_delay if wait is None else min(wait, global_delay)
+                    chat_bucket = self._chat_bucket(chat_id)
+                    chat_delay = chat_bucket.delay(now)
+                    if chat_delay > 0:
+                        # Чат исчерпал свой лимит — пропускаем его, остальные не ждут
+                        wait = chat_delay if wait is None else min(wait, chat_delay)
+                        index += 1
+                        continue
+                    self.global_bucket.take()
+                    chat_bucket.take()
+                    del lane[index]
+                    future.set_result(None)
+            return wait
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            wait = self._dispatch(time.monotonic())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+# Приоритет отправок текущей задачи (рассылка выставляет LOW)
+send_priority = contextvars.ContextVar("send_priority", default=SendScheduler.HIGH)
+
+# Middleware сессии бота: каждое сообщение в чат ждёт разрешения планировщика,
+# после 429 Too Many Requests отправка повторяется через retry_after. Первый
+# 429 придерживает только этот чат; если и повтор получил 429, лимит, видимо,
+# общий для бота, и пауза ставится на все отправки.
+class SendSchedulerMiddleware(BaseRequestMiddleware):
+    def __init__(self, scheduler, max_retries=3):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        priority = send_priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self.scheduler.acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.inc("send_retries_total", method=type(method).__name__)
+                if attempt == 0:
+                    logger.warning("Лимит Telegram для чата %s, повтор через %s с", chat_id, e.retry_after,
+                                   extra=log_fields(chat_id=chat_id, retry_after=e.retry_after))
+                    self.scheduler.backoff(chat_id, e.retry_after)
+                else:
+                    logger.warning("Повторный лимит Telegram для чата %s, пауза всех отправок на %s с",
+                                   chat_id, e.retry_after, extra=log_fields(chat_id=chat_id, retry_after=e.retry_after))
+                    self.scheduler.pause(e.retry_after)
+
+# Число процессов-воркеров. Только для webhook: getUpdates допускает
+# одного получателя, поэтому polling всегда работает в одном процессе
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WORKERS = max(1, int(os.getenv("WORKERS", 1))) if BOT_MODE == "webhook" else 1
+
+# Лимиты общие для всех воркеров (см. SendLimits), поэтому не делятся между ними
+send_scheduler = SendScheduler(
+    rate=float(os.getenv("SEND_RATE", 25)),
+    burst=int(os.getenv("SEND_BURST", 5)),
+    chat_rate=float(os.getenv("SEND_CHAT_RATE", 1)),
+    chat_burst=int(os.getenv("SEND_CHAT_BURST", 3)),
+    group_rate=float(os.getenv("SEND_GROUP_RATE_PER_MINUTE", 20)) / 60,
+)
 
 # Определяем состояния для FSM
 class SearchStates(StatesGroup):
@@ -23,44 +441,186 @@ class AddCharacterStates(StatesGroup):
     waiting_for_post_link = State()
     waiting_for_art_link = State()
 
+class ImportStates(StatesGroup):
+    waiting_for_file = State()
+
+# Хранилище FSM в отдельном файле SQLite (не в файле каталога, который
+# подменяется синхронизацией): состояния переживают перезапуск и общие для
+# всех воркеров. Изменения копятся в памяти и раз в flush_interval пишутся
+# одной транзакцией, чтение видит и ещё не записанные изменения.
+# Состояние, которое не менялось дольше ttl секунд, считается сброшенным.
+class SqliteStorage(BaseStorage):
+    PURGE_INTERVAL = 600
+
+    def __init__(self, path, ttl=86400, flush_interval=0.05):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self.pending = {}  # ключ -> (состояние, данные), ещё не записанные
+        self.flushing = {}  # пакет, который пишется прямо сейчас
+        self.flush_task = None
+        self.purged_at = 0.0
+        self.pages_purged_at = 0.0
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-storage")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA busy_timeout = 5000")
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute('''CREATE TABLE IF NOT EXISTS fsm_states
+                              (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, expires_at REAL NOT NULL)''')
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at)")
+        connection.execute('''CREATE TABLE IF NOT EXISTS result_pages
+                              (token TEXT PRIMARY KEY, ids TEXT NOT NULL, expires_at REAL NOT NULL)''')
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_result_pages_expires_at ON result_pages (expires_at)")
+        connection.commit()
+        return connection
+
+    def _call(self, func, args):
+        if self.connection is None:
+            self.connection = self._connect()
+        return func(*args)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, func, args)
+
+    def _load(self, key):
+        row = self.connection.execute("SELECT state, data FROM fsm_states WHERE key = ? AND expires_at > ?",
+                                      (key, time.time())).fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, {})
+
+    def _write(self, batch):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM fsm_states WHERE key = ?",
+                [(key,) for key, (state, data) in batch.items() if state is None and not data],
+            )
+            self.connection.executemany(
+                "INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, expires_at = excluded.expires_at",
+                [(key, state, json.dumps(data, ensure_ascii=False), now + self.ttl)
+                 for key, (state, data) in batch.items() if state is not None or data],
+            )
+            if now - self.purged_at > self.PURGE_INTERVAL:
+                self.connection.execute("DELETE FROM fsm_states WHERE expires_at <= ?", (now,))
+                self.purged_at = now
+
+    async def _record(self, key):
+        record = self.pending.get(key) or self.flushing.get(key)
+        if record is None:
+            record = await self._run(self._load, key)
+        return record
+
+    def _set(self, key, record):
+        self.pending[key] = record
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            self.flushing, self.pending = self.pending, {}
+            try:
+                await self._run(self._write, self.flushing)
+            except Exception as e:
+                # Не теряем изменения: вернём их в очередь до следующей записи
+                logger.error("Ошибка записи состояний FSM: %s", e, extra=log_fields(states=len(self.flushing)))
+                self.pending = {**self.flushing, **self.pending}
+                return
+            finally:
+                self.flushing = {}
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        _, data = await self._record(key)
+        self._set(key, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key):
+        state, _ = await self._record(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = self.key_builder.build(key)
+        state, _ = await self._record(key)
+        self._set(key, (state, data.copy()))
+
+    async def get_data(self, key):
+        _, data = await self._record(self.key_builder.build(key))
+        return data.copy()
+
+    # Страницы результатов поиска (токен -> список id) лежат в том же файле:
+    # нажатие ◀/▶ может прийти в любой воркер. Пишутся сразу, без пакета.
+    def _save_page(self, token, ids, ttl):
+        now = time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO result_pages (token, ids, expires_at) VALUES (?, ?, ?)",
+                                    (token, json.dumps(ids), now + ttl))
+            if now - self.pages_purged_at > self.PURGE_INTERVAL:
+                self.connection.execute("DELETE FROM result_pages WHERE expires_at <= ?", (now,))
+                self.pages_purged_at = now
+
+    def _load_page(self, token):
+        row = self.connection.execute("SELECT ids FROM result_pages WHERE token = ? AND expires_at > ?",
+                                      (token, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def set_page(self, token, ids, ttl):
+        await self._run(self._save_page, token, ids, ttl)
+
+    async def get_page(self, token):
+        return await self._run(self._load_page, token)
+
+    async def close(self):
+        if self.flush_task is not None:
+            await self.flush_task
+        await self.flush()
+        if self.connection is not None:
+            await self._run(self.connection.close)
+            self.connection = None
+        self.executor.shutdown(wait=True)
+
+# Хранилище FSM: sqlite (по умолчанию) или memory (состояния живут до перезапуска)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+if FSM_STORAGE == "sqlite":
+    storage = SqliteStorage(
+        os.getenv("FSM_STORAGE_FILE", "fsm_state.db"),
+        ttl=int(os.getenv("FSM_STATE_TTL", 86400)),
+        flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", 0.05)),
+    )
+else:
+    storage = MemoryStorage()
+
 # Инициализация aiogram
 bot = Bot(token=os.getenv("TELEGRAM_TOKEN"))
-dp = Dispatcher()
-
-# Публичная ссылка на файл базы данных в Mail.ru Cloud
-DATABASE_URL = "https://cloud.mail.ru/public/3VX7/ppkUqGWHF"  # Укажи правильную прямую ссылку
-
-# Скачивание файла базы данных из облака
-print("Скачивание базы данных из облака...")
-database_file = 'comics_characters.db'
-try:
-    response = requests.get(DATABASE_URL)
-    with open(database_file, 'wb') as f:
-        f.write(response.content)
-    print("База данных успешно скачана.")
-    # Проверяем, что скачали
-    with open(database_file, 'rb') as f:
-        first_bytes = f.read(16).decode('utf-8', errors='ignore')
-        print(f"Первые 16 байт файла: {first_bytes}")
-        if first_bytes.startswith('SQLite'):
-            print("Файл выглядит как база данных SQLite.")
-        else:
-            print("Скачанный файл не является базой данных SQLite (возможно, это HTML-страница).")
-except Exception as e:
-    print(f"Ошибка при скачивании базы данных: {e}")
+dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+bot.session.middleware(SendSchedulerMiddleware(send_scheduler, max_retries=int(os.getenv("SEND_MAX_RETRIES", 3))))
+bot.session.middleware(TelegramMetricsMiddleware())
+
+# Публичная ссылка на файл базы данных в Mail.ru Cloud (пустая строка отключает синхронизацию)
+DATABASE_URL = os.getenv("DATABASE_URL", "https://cloud.mail.ru/public/3VX7/ppkUqGWHF")  # Укажи правильную прямую ссылку
+database_file = os.getenv("DATABASE_FILE", 'comics_characters.db')
 
 # Проверка валидности базы данных
 def initialize_database():
-    print("Проверка валидности базы данных...")
+    logger.info("Проверка валидности базы данных...")
     try:
         temp_conn = sqlite3.connect(database_file)
         temp_cursor = temp_conn.cursor()
         temp_cursor.execute("SELECT * FROM sqlite_master WHERE type='table';")
         temp_conn.close()
-        print("Файл является валидной базой данных SQLite.")
+        logger.info("Файл является валидной базой данных SQLite.")
     except sqlite3.DatabaseError as e:
-        print(f"Файл не является валидной базой данных: {e}")
-        print("Создаём новую базу данных...")
+        logger.warning("Файл не является валидной базой данных: %s", e)
+        logger.info("Создаём новую базу данных...")
         # Создаём новую базу, если скачанный файл недействителен
         with open(database_file, 'wb') as f:
             pass  # Очищаем файл
@@ -69,62 +629,1029 @@ def initialize_database():
         temp_cursor.execute('''CREATE TABLE IF NOT EXISTS characters
                               (name TEXT, publisher TEXT, universe TEXT, type TEXT, description TEXT, post_link TEXT, art_link TEXT)''')
         # Добавляем начальные данные
-        temp_cursor.execute("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)",
-                            ("Человек-паук Нуар", "Marvel", "Marvel Noir", "Герой",
-                             "Мрачный Питер Паркер из 1930-х, мститель с револьвером.",
-                             "https://t.me/KomicsHub/3", "https://t.me/KomicsHub/4"))
-        temp_cursor.execute("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)",
-                            ("Спаун", "Image", "Spawn Universe", "Антигерой",
-                             "Эл Симмонс, наемник, ставший мстителем ада с цепями.",
-                             "https://t.me/komikshub/post2", "https://example.com/art2.jpg"))
+        temp_cursor.executemany("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)", SEED_CHARACTERS)
         temp_conn.commit()
         temp_conn.close()
-        print("Новая база данных создана с начальными данными.")
-
-# Подключение к базе данных SQLite с поддержкой UTF-8
-print("Подключение к базе данных...")
-try:
-    conn = sqlite3.connect(database_file)
-    cursor = conn.cursor()
-    conn.execute('PRAGMA encoding = "UTF-8";')
-    print("База данных успешно подключена.")
-except Exception as e:
-    print(f"Ошибка подключения к базе данных: {e}")
-    raise
-
-# Создание таблицы в базе данных
-print("Создание таблицы characters...")
-try:
-    cursor.execute('''CREATE TABLE IF NOT EXISTS characters
-                   (name TEXT, publisher TEXT, universe TEXT, type TEXT, description TEXT, post_link TEXT, art_link TEXT)''')
-    print("Таблица characters создана или уже существует.")
-except Exception as e:
-    print(f"Ошибка при создании таблицы: {e}")
-
-# Функция для проверки и заполнения базы данных
-def ensure_database_populated():
-    print("Проверка содержимого базы данных...")
+        logger.info("Новая база данных создана с начальными данными.")
+
+# Столбцы таблицы characters в порядке, в котором их ждут обработчики
+CHARACTER_FIELDS = "name, publisher, universe, type, description, post_link, art_link"
+
+# Миграции схемы: номер текущей версии хранится в PRAGMA user_version,
+# каждая миграция выполняется в своей транзакции и поднимает версию на 1.
+# Применяются при каждом открытии файла, в том числе скачанного из облака.
+def migration_add_primary_key(connection):
+    # Явный целочисленный первичный ключ (сохраняем старые rowid как id) и индексы
+    connection.execute('''CREATE TABLE characters_new
+                          (id INTEGER PRIMARY KEY, name TEXT, publisher TEXT, universe TEXT, type TEXT,
+                           description TEXT, post_link TEXT, art_link TEXT)''')
+    connection.execute(f"INSERT INTO characters_new (id, {CHARACTER_FIELDS}) SELECT rowid, {CHARACTER_FIELDS} FROM characters")
+    connection.execute("DROP TABLE characters")
+    connection.execute("ALTER TABLE characters_new RENAME TO characters")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_characters_name ON characters (name)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_characters_publisher ON characters (publisher)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_characters_universe ON characters (universe)")
+
+def migration_add_fts(connection):
+    # Полнотекстовый индекс для SEARCH_ENGINE=fts, синхронизируемый триггерами.
+    # Если SQLite собран без FTS5 или без триграммного токенизатора (< 3.34),
+    # миграция ничего не создаёт, и поиск остаётся нечётким; migrate() повторит
+    # попытку при следующем открытии базы, например после обновления SQLite.
+    if connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'characters_fts'"
+    ).fetchone():
+        return
+    try:
+        connection.execute('''CREATE VIRTUAL TABLE characters_fts USING fts5
+                              (name, publisher, universe, type, description,
+                               content='characters', content_rowid='id', tokenize='trigram')''')
+    except sqlite3.OperationalError as e:
+        logger.warning("FTS5 с триграммным токенизатором недоступен, FTS-поиск отключён: %s", e)
+        return
+    fields = "name, publisher, universe, type, description"
+    connection.execute(f'''CREATE TRIGGER characters_fts_insert AFTER INSERT ON characters BEGIN
+                               INSERT INTO characters_fts (rowid, {fields})
+                               VALUES (new.id, new.name, new.publisher, new.universe, new.type, new.description);
+                           END''')
+    connection.execute(f'''CREATE TRIGGER characters_fts_delete AFTER DELETE ON characters BEGIN
+                               INSERT INTO characters_fts (characters_fts, rowid, {fields})
+                               VALUES ('delete', old.id, old.name, old.publisher, old.universe, old.type, old.description);
+                           END''')
+    connection.execute(f'''CREATE TRIGGER characters_fts_update AFTER UPDATE ON characters BEGIN
+                               INSERT INTO characters_fts (characters_fts, rowid, {fields})
+                               VALUES ('delete', old.id, old.name, old.publisher, old.universe, old.type, old.description);
+                               INSERT INTO characters_fts (rowid, {fields})
+                               VALUES (new.id, new.name, new.publisher, new.universe, new.type, new.description);
+                           END''')
+    connection.execute("INSERT INTO characters_fts (characters_fts) VALUES ('rebuild')")
+
+def migration_add_subscribers(connection):
+    # Подписчики рассылки о новых персонажах
+    connection.execute('''CREATE TABLE IF NOT EXISTS subscribers
+                          (chat_id INTEGER PRIMARY KEY, subscribed_at INTEGER)''')
+
+def migration_add_catalog_version(connection):
+    # Версия каталога растёт при любом изменении characters: по ней воркеры
+    # узнают, что каталог изменил другой процесс
+    connection.execute('''CREATE TABLE IF NOT EXISTS catalog_state
+                          (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)''')
+    connection.execute("INSERT OR IGNORE INTO catalog_state (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        connection.execute(f'''CREATE TRIGGER IF NOT EXISTS characters_version_{event.lower()} AFTER {event} ON characters BEGIN
+                                   UPDATE catalog_state SET version = version + 1 WHERE id = 1;
+                               END''')
+
+# Журнал изменений каталога: какой id изменила каждая версия. По нему воркеры
+# применяют чужие изменения точечно, а не перечитывают каталог целиком.
+# Хранятся последние CATALOG_CHANGES_KEPT версий.
+CATALOG_CHANGES_KEPT = 10000
+
+def migration_add_catalog_changes(connection):
+    connection.execute('''CREATE TABLE IF NOT EXISTS catalog_changes
+                          (version INTEGER PRIMARY KEY, id INTEGER NOT NULL)''')
+    for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+        connection.execute(f"DROP TRIGGER IF EXISTS characters_version_{event.lower()}")
+        connection.execute(f'''CREATE TRIGGER characters_version_{event.lower()} AFTER {event} ON characters BEGIN
+                                   UPDATE catalog_state SET version = version + 1 WHERE id = 1;
+                                   INSERT OR REPLACE INTO catalog_changes (version, id)
+                                   SELECT version, {row}.id FROM catalog_state WHERE id = 1;
+                                   DELETE FROM catalog_changes
+                                   WHERE version <= (SELECT version FROM catalog_state WHERE id = 1) - {CATALOG_CHANGES_KEPT};
+                               END''')
+
+MIGRATIONS = [
+    migration_add_primary_key,  # версия 1
+    migration_add_fts,  # версия 2
+    migration_add_subscribers,  # версия 3
+    migration_add_catalog_version,  # версия 4
+    migration_add_catalog_changes,  # версия 5
+]
+
+def migrate(connection):
+    initial = connection.execute("PRAGMA user_version").fetchone()[0]
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Перечитываем версию внутри транзакции: файл мог обновить другой процесс
+            current = connection.execute("PRAGMA user_version").fetchone()[0]
+            if current >= version:
+                connection.rollback()
+                continue
+            logger.info("Миграция базы данных: версия %d -> %d (%s)", current, version, migration.__name__,
+                        extra=log_fields(schema_version=version))
+            migration(connection)
+            connection.execute(f"PRAGMA user_version = {version}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+    # Версия 2 могла быть выставлена без FTS-таблицы (SQLite без триграмм)
+    if initial >= 2 and not connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'characters_fts'"
+    ).fetchone():
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            migration_add_fts(connection)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+# Асинхронный слой доступа к SQLite: все записи идут через одно соединение
+# в отдельном потоке (писатель сериализован), чтение — через пул
+# WAL-соединений в фоновых потоках, поэтому запросы не блокируют polling
+class Database:
+    def __init__(self, path, readers=4, shared=False):
+        self.path = path
+        self.readers = readers
+        self.shared = shared  # файл открыт и другими процессами
+        self.write_conn = None
+        self.read_conns = queue.Queue()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.reader_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        connection.execute("PRAGMA busy_timeout = 5000")
+        return connection
+
+    def open(self):
+        logger.info("Подключение к базе данных...")
+        self._open_connections()
+        logger.info("База данных успешно подключена.")
+
+    # Соединения становятся доступны только после успешного открытия всех
+    # сразу: при ошибке уже открытые закрываются, пул остаётся пустым
+    def _open_connections(self):
+        connections = []
+        try:
+            write_conn = self._connect()
+            connections.append(write_conn)
+            write_conn.execute('PRAGMA encoding = "UTF-8";')
+            write_conn.execute("PRAGMA journal_mode = WAL")
+            write_conn.execute("PRAGMA synchronous = NORMAL")
+            logger.info("Создание таблицы characters...")
+            write_conn.execute('''CREATE TABLE IF NOT EXISTS characters
+                                  (name TEXT, publisher TEXT, universe TEXT, type TEXT, description TEXT, post_link TEXT, art_link TEXT)''')
+            write_conn.commit()
+            migrate(write_conn)
+            for _ in range(self.readers):
+                connection = self._connect()
+                connections.append(connection)
+                connection.execute("PRAGMA query_only = ON")
+        except Exception:
+            for connection in connections:
+                connection.close()
+            raise
+        self.write_conn = write_conn
+        for connection in connections[1:]:
+            self.read_conns.put(connection)
+
+    def _remove_wal_files(self):
+        for suffix in ("-wal", "-shm"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+    # Выполняется в потоке писателя: дожидается освобождения всех читающих
+    # соединений, закрывает их, атомарно подменяет файл и открывает заново.
+    # Прежний файл хранится до успешного открытия нового, при ошибке он
+    # возвращается на место, так что база не остаётся закрытой или испорченной.
+    def _replace_file(self, new_path):
+        if self.shared:
+            return self._restore_file(new_path)
+        # Подписчики не приходят из облака — переносим их в новый файл заранее
+        subscribers = self.write_conn.execute("SELECT chat_id, subscribed_at FROM subscribers").fetchall()
+        connection = sqlite3.connect(new_path)
+        try:
+            connection.executemany("INSERT OR IGNORE INTO subscribers (chat_id, subscribed_at) VALUES (?, ?)", subscribers)
+            connection.commit()
+        finally:
+            connection.close()
+
+        readers = [self.read_conns.get() for _ in range(self.readers)]
+        for connection in readers:
+            connection.close()
+        self.write_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.write_conn.close()
+        self.write_conn = None
+        backup_path = self.path + ".bak"
+        os.replace(self.path, backup_path)
+        self._remove_wal_files()
+        try:
+            os.replace(new_path, self.path)
+            self._open_connections()
+        except Exception:
+            logger.exception("Не удалось открыть новую базу данных, возвращаем прежнюю")
+            os.replace(backup_path, self.path)
+            self._remove_wal_files()
+            self._open_connections()
+            raise
+        os.remove(backup_path)
+
+    # Файл открыт другими воркерами, и подменять его нельзя: их соединения
+    # остались бы на старом файле, а закрываясь, удалили бы чужой -wal.
+    # Поэтому страницы копируются в ту же базу через backup API одной
+    # транзакцией, а версия каталога поднимается, чтобы воркеры перечитали его.
+    def _restore_file(self, new_path):
+        subscribers = self.write_conn.execute("SELECT chat_id, subscribed_at FROM subscribers").fetchall()
+        version = self.write_conn.execute("SELECT version FROM catalog_state").fetchone()[0]
+        source = sqlite3.connect(new_path)
+        try:
+            # Для WAL-базы backup требует одинакового размера страницы
+            page_size = self.write_conn.execute("PRAGMA page_size").fetchone()[0]
+            if source.execute("PRAGMA page_size").fetchone()[0] != page_size:
+                source.execute("PRAGMA journal_mode = DELETE")
+                source.execute(f"PRAGMA page_size = {page_size}")
+                source.execute("VACUUM")
+            source.backup(self.write_conn)
+        finally:
+            source.close()
+        os.remove(new_path)
+        migrate(self.write_conn)
+        self.write_conn.executemany("INSERT OR IGNORE INTO subscribers (chat_id, subscribed_at) VALUES (?, ?)", subscribers)
+        # Журнал скачанной базы к нашим версиям не относится: пропуск в журнале
+        # заставит воркеров перечитать каталог целиком
+        self.write_conn.execute("DELETE FROM catalog_changes")
+        self.write_conn.execute("UPDATE catalog_state SET version = ?", (version + 1,))
+        self.write_conn.commit()
+
+    async def replace_file(self, new_path):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.writer, self._replace_file, new_path)
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.reader_pool.shutdown(wait=True)
+        while not self.read_conns.empty():
+            self.read_conns.get_nowait().close()
+        if self.write_conn is not None:
+            self.write_conn.close()
+            self.write_conn = None
+
+    def _read(self, func, args):
+        connection = self.read_conns.get()
+        try:
+            return func(connection, *args)
+        finally:
+            self.read_conns.put(connection)
+
+    def _write(self, func, args):
+        try:
+            result = func(self.write_conn, *args)
+            self.write_conn.commit()
+            return result
+        except Exception:
+            self.write_conn.rollback()
+            raise
+
+    # Выполняет func(connection, *args) на свободном читающем соединении
+    async def read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with metrics.timer("db_seconds", op="read"):
+            return await loop.run_in_executor(self.reader_pool, self._read, func, args)
+
+    # Выполняет func(connection, *args) в потоке писателя в одной транзакции
+    async def write(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with metrics.timer("db_seconds", op="write"):
+            return await loop.run_in_executor(self.writer, self._write, func, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda connection: connection.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda connection: connection.execute(sql, params).fetchall())
+
+    # Возвращает rowid последней вставленной строки
+    async def execute(self, sql, params=()):
+        return await self.write(lambda connection: connection.execute(sql, params).lastrowid)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.write(lambda connection: connection.executemany(sql, seq_of_params).rowcount)
+
+    # Готовые параметризованные запросы к таблице characters
+    async def all_characters(self):
+        return await self.fetchall(f"SELECT id, {CHARACTER_FIELDS} FROM characters")
+
+    async def catalog_version(self):
+        return (await self.fetchone("SELECT version FROM catalog_state"))[0]
+
+    # id, изменённые версиями после since до until включительно; None, если
+    # журнал неполон (очищен при замене файла) или изменений больше limit
+    async def catalog_changes(self, since, until, limit):
+        if until - since > limit:
+            return None
+        rows = await self.fetchall("SELECT id FROM catalog_changes WHERE version > ? AND version <= ?", (since, until))
+        if len(rows) != until - since:
+            return None
+        return list(dict.fromkeys(rowid for rowid, in rows))
+
+    async def characters_by_ids(self, ids, chunk_size=500):
+        rows = {}
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            for rowid, *row in await self.fetchall(
+                f"SELECT id, {CHARACTER_FIELDS} FROM characters WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+            ):
+                rows[rowid] = tuple(row)
+        return rows
+
+    async def count_characters(self):
+        return (await self.fetchone("SELECT COUNT(*) FROM characters"))[0]
+
+    async def character_by_id(self, character_id):
+        return await self.fetchone(f"SELECT {CHARACTER_FIELDS} FROM characters WHERE id = ?", (character_id,))
+
+    async def insert_character(self, row):
+        return await self.execute(f"INSERT INTO characters ({CHARACTER_FIELDS}) VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+
+    async def insert_characters(self, rows):
+        return await self.executemany(f"INSERT INTO characters ({CHARACTER_FIELDS}) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+db = Database(database_file, readers=int(os.getenv("DB_READERS", 4)), shared=WORKERS > 1)
+
+# Начальные данные для пустой базы
+SEED_CHARACTERS = [
+    ("Человек-паук Нуар", "Marvel", "Marvel Noir", "Герой",
+     "Мрачный Питер Паркер из 1930-х, мститель с револьвером.",
+     "https://t.me/KomicsHub/3", "https://t.me/KomicsHub/4"),
+    ("Спаун", "Image", "Spawn Universe", "Антигерой",
+     "Эл Симмонс, наемник, ставший мстителем ада с цепями.",
+     "https://t.me/komikshub/post2", "https://example.com/art2.jpg"),
+]
+
+# Если FTS-таблицы нет (SQLite без FTS5), переключаемся на нечёткий поиск
+def use_fallback_search():
+    global search_engine
+    if search_engine is search_index or FtsSearchEngine.available(db.write_conn):
+        return
+    logger.warning("SEARCH_ENGINE=fts, но таблица characters_fts отсутствует: используется нечёткий поиск")
+    catalog.listeners.remove(search_engine)
+    search_engine = search_index
+    catalog.listeners.insert(0, search_index)
+
+# Функция для проверки и заполнения базы данных (только при запуске)
+async def ensure_database_populated():
+    logger.info("Проверка содержимого базы данных...")
     try:
-        cursor.execute("SELECT * FROM characters")
-        results = cursor.fetchall()
-        print(f"Данные в базе: {results}")
-        if not results:
-            print("ВНИМАНИЕ: База данных пуста! Добавляем начальные данные...")
-            cursor.execute("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)",
-                           ("Человек-паук Нуар", "Marvel", "Marvel Noir", "Герой",
-                            "Мрачный Питер Паркер из 1930-х, мститель с револьвером.",
-                            "https://t.me/KomicsHub/3", "https://t.me/KomicsHub/4"))
-            cursor.execute("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)",
-                           ("Спаун", "Image", "Spawn Universe", "Антигерой",
-                            "Эл Симмонс, наемник, ставший мстителем ада с цепями.",
-                            "https://t.me/komikshub/post2", "https://example.com/art2.jpg"))
-            conn.commit()
-            print("Начальные данные успешно добавлены.")
+        count = await db.count_characters()
+        logger.info("Персонажей в базе: %d", count, extra=log_fields(characters=count))
+        if not count:
+            logger.info("ВНИМАНИЕ: База данных пуста! Добавляем начальные данные...")
+            await db.insert_characters(SEED_CHARACTERS)
+            logger.info("Начальные данные успешно добавлены.")
     except Exception as e:
-        print(f"Ошибка при проверке содержимого базы данных: {e}")
+        logger.error("Ошибка при проверке содержимого базы данных: %s", e)
+
+# Тексты персонажей для поиска в памяти, синхронизируемые с каталогом.
+# Снимок (rowid, тексты) в порядке таблицы сортируется один раз в prepare()
+# (при перезагрузке — в потоке), а изменения вставляются в копии списков на
+# своё место по bisect: новые id всегда последние, сортировка не повторяется.
+class TextSnapshot:
+    def __init__(self):
+        self.texts = {}  # rowid -> текст для сравнения
+        self.snapshot = ([], [])  # (rowid, тексты) в порядке таблицы
+
+    def combined_text(self, row):
+        raise NotImplementedError
+
+    def prepare(self, rows):
+        texts = {rowid: self.combined_text(row) for rowid, row in rows}
+        rowids = sorted(texts)
+        return texts, (rowids, [texts[rowid] for rowid in rowids])
+
+    def install(self, state):
+        self.texts, self.snapshot = state
+
+    def rebuild(self, rows):
+        self.install(self.prepare(rows))
+
+    # Списки снимка не меняются на месте: тот, что сейчас оценивается в
+    # другом потоке, остаётся прежним
+    def add(self, rowid, row):
+        text = self.texts[rowid] = self.combined_text(row)
+        rowids, texts = self.snapshot[0].copy(), self.snapshot[1].copy()
+        position = bisect.bisect_left(rowids, rowid)
+        if position < len(rowids) and rowids[position] == rowid:
+            texts[position] = text
+        else:
+            rowids.insert(position, rowid)
+            texts.insert(position, text)
+        self.snapshot = (rowids, texts)
+
+    def remove(self, rowid):
+        if self.texts.pop(rowid, None) is None:
+            return
+        rowids, texts = self.snapshot[0].copy(), self.snapshot[1].copy()
+        position = bisect.bisect_left(rowids, rowid)
+        del rowids[position], texts[position]
+        self.snapshot = (rowids, texts)
+
+# Каталог в памяти для нечёткого поиска. Порог partial_ratio >= 50 очень
+# мягкий: без потерь заранее отсеять удаётся лишь несколько процентов строк
+# (фильтр по общим символам на 100 тыс. строк оставлял 97%), а сам отбор
+# на чистом Python стоил дороже оценки. Поэтому оцениваются все тексты
+# одним вызовом cdist в пуле scoring_executor, а цикл событий только ждёт.
+class SearchIndex(TextSnapshot):
+    def __init__(self, threshold=50):
+        super().__init__()
+        self.threshold = threshold
+
+    @staticmethod
+    def combined_text(row):
+        name, publisher, universe, type_ = row[:4]
+        return f"{name} {publisher} {universe} {type_}".lower()
+
+    # Подходит ли персонаж запросу (для точной инвалидации кэшей)
+    def matches(self, query_parts, row):
+        text = self.combined_text(row)
+        return any(fuzz.partial_ratio(part, text) >= self.threshold for part in query_parts)
+
+    # Возвращает не больше limit пар (rowid, оценка) по убыванию оценки,
+    # при равных оценках — в порядке таблицы
+    async def search(self, query_parts, limit):
+        query_parts = list(dict.fromkeys(query_parts))
+        rowids, texts = self.snapshot
+        # Запрос без слов (например, «-») ничему не подходит; cdist с пустым
+        # списком запросов дал бы пустую матрицу
+        if not rowids or not query_parts:
+            return []
+        metrics.inc("search_candidates_total", len(rowids))
+        with metrics.timer("search_seconds", stage="score"):
+            best = await scoring_executor.score(query_parts, texts, self.threshold, limit)
+        results = [(rowids[position], score) for position, score in best]
+        logger.debug("Поиск: оценено %d, лучших совпадений %d", len(rowids), len(results))
+        return results
+
+# Пул слишком загружен, новые поисковые запросы отклоняются
+class SearchOverloadedError(Exception):
+    pass
+
+# Пакетная оценка сходства в пуле потоков: все слова запроса сравниваются
+# со всеми текстами одним вызовом rapidfuzz.process.cdist, который
+# отпускает GIL; отбор по порогу и лучшие limit тоже считаются в пуле,
+# а обработчик только ждёт результат.
+# partial_ratio из rapidfuzz ищет лучшее выравнивание окна, а прежний
+# fuzzywuzzy — эвристически по блокам совпадений и иногда занижал оценку.
+# Поэтому при пороге 50 находится надмножество прежних совпадений
+# (например, «бледный» и «алый-шторм гандэ dc elseworlds антигерой»: 54.5
+# вместо 43); дополнительные совпадения слабые и в ранжированной выдаче
+# оказываются ниже.
+class ScoringExecutor:
+    def __init__(self, workers, queue_limit):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scoring")
+        self.queue_limit = queue_limit
+        self.pending = 0
+
+    # [(позиция, оценка)] не больше limit текстов с оценкой >= threshold по
+    # убыванию оценки, при равных оценках — по позиции
+    @staticmethod
+    def _score_batch(query_parts, candidates, threshold, limit):
+        matrix = process.cdist(query_parts, candidates, scorer=fuzz.partial_ratio, score_cutoff=threshold)
+        scores = matrix.max(axis=0)
+        positions = numpy.flatnonzero(scores >= threshold)
+        positions = positions[numpy.argsort(-scores[positions], kind="stable")[:limit]]
+        return list(zip(positions.tolist(), scores[positions].tolist()))
+
+    # Любая поисковая работа в пуле с общим ограничением очереди
+    async def run(self, function, *args):
+        if self.pending >= self.queue_limit:
+            metrics.inc("search_rejected_total")
+            raise SearchOverloadedError(f"в очереди уже {self.pending} запросов")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def score(self, query_parts, candidates, threshold, limit):
+        return await self.run(self._score_batch, query_parts, candidates, threshold, limit)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+scoring_executor = ScoringExecutor(
+    workers=int(os.getenv("SEARCH_WORKERS", os.cpu_count() or 2)),
+    queue_limit=int(os.getenv("SEARCH_QUEUE_LIMIT", 64)),
+)
+search_index = SearchIndex(threshold=50)
+
+# Дисковый поиск для больших каталогов: FTS5-таблица с триграммным
+# токенизатором (нечёткие совпадения подстрок, включая описание),
+# ранжирование bm25. Отдаёт результаты в том же виде, что и SearchIndex.
+# Триграммам нужны подстроки от 3 символов. Более короткие слова при наличии
+# длинных отбрасываются, а запрос только из коротких слов («с», «сп» при
+# inline-вводе) ищется подстрокой в именах из памяти (снимок TextSnapshot) в
+# пуле scoring_executor: полный проход по таблице занимал бы соединение
+# чтения на секунду на 100 тыс. строк.
+class FtsSearchEngine(TextSnapshot):
+    # Веса столбцов для bm25: name, publisher, universe, type, description
+    WEIGHTS = (10.0, 2.0, 2.0, 1.0, 1.0)
+    COLUMNS = ("name", "publisher", "universe", "type", "description")
+
+    @staticmethod
+    def available(connection):
+        return connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'characters_fts'"
+        ).fetchone() is not None
+
+    @staticmethod
+    def combined_text(row):
+        return (row[0] or "").lower()
+
+    @staticmethod
+    def long_parts(query_parts):
+        return [part for part in query_parts if len(part) >= 3]
+
+    # Подходит ли персонаж запросу: длинное слово — подстрока любого из
+    # индексируемых полей, запрос из одних коротких слов — подстрока имени
+    def matches(self, query_parts, row):
+        long_parts = self.long_parts(query_parts)
+        if long_parts:
+            text = " ".join(str(value or "") for value in row[:5]).lower()
+            return any(part in text for part in long_parts)
+        name = self.combined_text(row)
+        return any(part in name for part in query_parts)
+
+    # Первые limit id в порядке таблицы, в имени которых есть одно из слов.
+    # Проверка подстроки идёт через map без цикла на Python (около 8 мс на
+    # слово при 100 тыс. имён без совпадений) и останавливается на limit.
+    @staticmethod
+    def _match_names(query_parts, rowids, names, limit):
+        found = set()
+        for part in query_parts:
+            matched = compress(rowids, map(operator.contains, names, repeat(part)))
+            found.update(islice(matched, limit))
+        return sorted(found)[:limit]
+
+    # Возвращает [(id, оценка)] по убыванию релевантности (оценка = -bm25,
+    # для запроса из коротких слов — 0 в порядке таблицы)
+    async def search(self, query_parts, limit):
+        query_parts = list(dict.fromkeys(query_parts))
+        long_parts = self.long_parts(query_parts)
+        if not long_parts:
+            if not query_parts:
+                return []
+            rowids, names = self.snapshot
+            with metrics.timer("search_seconds", stage="names"):
+                found = await scoring_executor.run(self._match_names, query_parts, rowids, names, limit)
+            metrics.inc("search_candidates_total", len(found))
+            return [(rowid, 0.0) for rowid in found]
+        with metrics.timer("search_seconds", stage="fts"):
+            match = " OR ".join('"' + part.replace('"', '""') + '"' for part in long_parts)
+            weights = ", ".join(str(weight) for weight in self.WEIGHTS)
+            rows = await db.fetchall(
+                f"SELECT rowid, -bm25(characters_fts, {weights}) AS score FROM characters_fts "
+                "WHERE characters_fts MATCH ? ORDER BY score DESC LIMIT ?",
+                (match, limit),
+            )
+        metrics.inc("search_candidates_total", len(rows))
+        return rows
+
+# Движок поиска: fuzzy (индекс в памяти + rapidfuzz) или fts (SQLite FTS5).
+# Оба отдают [(id, оценка)] через search() и проверку matches() для кэша.
+SEARCH_ENGINE = os.getenv("SEARCH_ENGINE", "fuzzy")
+search_engine = FtsSearchEngine() if SEARCH_ENGINE == "fts" else search_index
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", 50))
+
+# Нормализация поискового запроса: нижний регистр, без дефисов и лишних пробелов
+def normalize_query(text):
+    query_parts = (text or "").lower().replace("-", " ").split()  # Разбиваем запрос на слова
+    return " ".join(query_parts), query_parts
+
+# Кэш с вытеснением давно не использованных записей (LRU) и сроком жизни (TTL)
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # ключ -> (время истечения, значение)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.data.clear()
+
+# Готовые карточки персонажей: текст и клавиатура строятся один раз на
+# персонажа и сбрасываются только при изменении этого персонажа
+class CardCache:
+    def __init__(self):
+        self.cards = {}  # rowid -> (текст, клавиатура)
+
+    def get(self, rowid):
+        card = self.cards.get(rowid)
+        if card is None:
+            row = catalog.get(rowid)
+            if row is None:
+                return None
+            name, publisher, universe, type_, desc, link, art = row
+            text = f"🦸 {name}\n📚 Издатель: {publisher}\n🌌 Вселенная: {universe}\n🦸 Тип: {type_}\n📖 {desc}\n📜 Пост: {link}"
+            buttons = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="Арт", url=art)]
+            ])
+            card = self.cards[rowid] = (text, buttons)
+        return card
+
+    def prepare(self, rows):
+        return None
+
+    def install(self, state):
+        self.cards.clear()
+
+    def add(self, rowid, row):
+        self.cards.pop(rowid, None)
+
+    def remove(self, rowid):
+        self.cards.pop(rowid, None)
+
+# Кэш результатов поиска: нормализованный запрос -> лучшие [(rowid, оценка)]
+# по убыванию оценки. При добавлении персонажа сбрасываются только запросы, которым он
+# подходит, при удалении — только запросы, где он был в результатах.
+class QueryCache(TTLCache):
+    def prepare(self, rows):
+        return None
+
+    def install(self, state):
+        self.clear()
+
+    def add(self, rowid, row):
+        self.remove(rowid)
+        stale = [query for query in self.data if search_engine.matches(query.split(), row)]
+        for query in stale:
+            del self.data[query]
+
+    def remove(self, rowid):
+        stale = [query for query, (_, matches) in self.data.items() if any(match[0] == rowid for match in matches)]
+        for query in stale:
+            del self.data[query]
+
+card_cache = CardCache()
+query_cache = QueryCache(
+    maxsize=int(os.getenv("QUERY_CACHE_SIZE", 2048)),
+    ttl=int(os.getenv("QUERY_CACHE_TTL", 3600)),
+)
+metrics.describe("query_cache_total", "counter", "Обращения к кэшу результатов поиска")
+
+# Поиск с кэшем результатов; результат кладётся в кэш, только если каталог
+# не менялся во время поиска
+async def search_characters(query, query_parts):
+    matches = query_cache.get(query)
+    metrics.inc("query_cache_total", result="miss" if matches is None else "hit")
+    if matches is None:
+        version = catalog.version
+        matches = await search_engine.search(query_parts, SEARCH_TOP_K)
+        if catalog.version == version:
+            query_cache.set(query, matches)
+    return matches
+
+# Снимок каталога в памяти процесса. Обработчики читают персонажей только
+# отсюда, а version меняется лишь при записи, поэтому производные структуры
+# (поисковый индекс и т.п.) обновляются вместе со снимком, без пересканирования
+class Catalog:
+    def __init__(self, listeners=()):
+        self.version = 0
+        self.rows = {}  # rowid -> строка таблицы characters
+        self.names = {}  # имя -> rowid первого персонажа с таким именем
+        self.listeners = list(listeners)
+        self.reload_lock = asyncio.Lock()
+        self.journal = None  # изменения во время reload()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, rowid):
+        return self.rows.get(rowid)
+
+    def id_by_name(self, name):
+        return self.names.get(name)
+
+    # Полный снимок из строк вида (rowid, name, publisher, ...): prepare() не
+    # трогает текущее состояние и может выполняться в потоке, install() только
+    # подменяет готовые структуры
+    def prepare(self, rows):
+        rows = {rowid: tuple(row) for rowid, *row in rows}
+        names = {}
+        for rowid, row in rows.items():
+            names.setdefault(row[0], rowid)
+        return rows, names, [listener.prepare(rows.items()) for listener in self.listeners]
+
+    def install(self, snapshot):
+        self.rows, self.names, states = snapshot
+        self.version += 1
+        for listener, state in zip(self.listeners, states):
+            listener.install(state)
+        logger.info("Каталог загружен: %d персонажей, версия %d", len(self.rows), self.version,
+                    extra=log_fields(characters=len(self.rows), catalog_version=self.version))
+
+    def load(self, rows):
+        self.install(self.prepare(rows))
+
+    # Перезагрузка без блокировки цикла событий: снимок строится в потоке, а
+    # изменения, сделанные за это время в этом процессе, повторяются поверх него
+    async def reload(self, fetch_rows):
+        async with self.reload_lock:
+            self.journal = []
+            try:
+                rows = await fetch_rows()
+                snapshot = await asyncio.get_running_loop().run_in_executor(None, self.prepare, rows)
+                self.install(snapshot)
+                journal, self.journal = self.journal, None
+                for rowid, row in journal:
+                    if row is None:
+                        self.remove(rowid)
+                    else:
+                        self.add(rowid, row)
+            finally:
+                self.journal = None
+
+    def add(self, rowid, row):
+        if self.journal is not None:
+            self.journal.append((rowid, row))
+        self.rows[rowid] = row
+        self.names.setdefault(row[0], rowid)
+        self.version += 1
+        for listener in self.listeners:
+            listener.add(rowid, row)
+
+    def remove(self, rowid):
+        if self.journal is not None:
+            self.journal.append((rowid, None))
+        row = self.rows.pop(rowid, None)
+        if row is None:
+            return
+        if self.names.get(row[0]) == rowid:
+            del self.names[row[0]]
+            for other_id, other in self.rows.items():
+                if other[0] == row[0]:
+                    self.names[row[0]] = other_id
+                    break
+        self.version += 1
+        for listener in self.listeners:
+            listener.remove(rowid)
+
+# Компактный набор id: массив array('q') для выбора за O(1) и позиции
+# элементов для удаления за O(1) (на место удалённого ставится последний)
+class IdSet:
+    def __init__(self):
+        self.ids = array('q')
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, rowid):
+        if rowid in self.positions:
+            return
+        self.positions[rowid] = len(self.ids)
+        self.ids.append(rowid)
+
+    def remove(self, rowid):
+        position = self.positions.pop(rowid, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if position < len(self.ids):
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def choice(self):
+        if not self.ids:
+            return None
+        return self.ids[random.randrange(len(self.ids))]
+
+# Выбор случайного персонажа без ORDER BY RANDOM(): общий набор id и наборы
+# по значениям фасетов (издатель, тип), синхронизируемые с каталогом
+class RandomPicker:
+    FACETS = {"publisher": 1, "type": 3}
+
+    def __init__(self):
+        self.all_ids = IdSet()
+        self.facets = {facet: {} for facet in self.FACETS}
+        self.values = {}  # rowid -> значения фасетов этого персонажа
+
+    def prepare(self, rows):
+        picker = RandomPicker()
+        for rowid, row in rows:
+            picker.add(rowid, row)
+        return picker
+
+    def install(self, picker):
+        self.all_ids, self.facets, self.values = picker.all_ids, picker.facets, picker.values
+
+    def add(self, rowid, row):
+        self.remove(rowid)
+        self.all_ids.add(rowid)
+        values = {facet: (row[column] or "").strip().lower() for facet, column in self.FACETS.items()}
+        for facet, value in values.items():
+            self.facets[facet].setdefault(value, IdSet()).add(rowid)
+        self.values[rowid] = values
+
+    def remove(self, rowid):
+        self.all_ids.remove(rowid)
+        for facet, value in self.values.pop(rowid, {}).items():
+            ids = self.facets[facet][value]
+            ids.remove(rowid)
+            if not ids:
+                del self.facets[facet][value]
+
+    # Случайный id; value без facet ищется среди издателей, затем среди типов
+    def pick(self, value=None, facet=None):
+        if value is None:
+            return self.all_ids.choice()
+        value = value.strip().lower()
+        for name in ([facet] if facet else self.FACETS):
+            ids = self.facets[name].get(value)
+            if ids:
+                return ids.choice()
+        return None
+
+random_picker = RandomPicker()
+catalog = Catalog(listeners=[search_engine, random_picker, card_cache, query_cache])
+
+# Синхронизация файла базы данных с облаком: потоковое скачивание во
+# временный файл, условные запросы (ETag/Last-Modified), проверка заголовка
+# SQLite и контрольной суммы, атомарная подмена файла и перезагрузка
+# открытых соединений и каталога. Облачный файл считается источником истины.
+class DatabaseSync:
+    SQLITE_HEADER = b"SQLite format 3\x00"
+
+    def __init__(self, url, path, expected_sha256=None, chunk_size=64 * 1024, timeout=120):
+        self.url = url
+        self.path = path
+        self.meta_path = f"{path}.sync.json"
+        self.expected_sha256 = expected_sha256.lower() if expected_sha256 else None
+        self.chunk_size = chunk_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.lock = asyncio.Lock()
+
+    def _load_meta(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Забыть ETag/Last-Modified, например если локальный файл был удалён
+    def reset(self):
+        try:
+            os.remove(self.meta_path)
+        except FileNotFoundError:
+            pass
+
+    def _save_meta(self, meta):
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def _file_sha256(path):
+        digest = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            return None
+        return digest.hexdigest()
+
+    # Полная проверка скачанного файла до подмены: открывается как SQLite,
+    # содержит characters, проходит все миграции и после них имеет все
+    # столбцы, которые ждут обработчики. Миграции применяются к temp-файлу,
+    # поэтому после подмены ничего не может упасть на несовместимой схеме.
+    @staticmethod
+    def _check_database(path):
+        connection = sqlite3.connect(path)
+        try:
+            status = connection.execute("PRAGMA quick_check").fetchone()[0]
+            if status != "ok":
+                raise sqlite3.DatabaseError(f"quick_check: {status}")
+            table = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'characters'"
+            ).fetchone()
+            if table is None:
+                raise sqlite3.DatabaseError("нет таблицы characters")
+            migrate(connection)
+            connection.execute(f"SELECT id, {CHARACTER_FIELDS} FROM characters LIMIT 1").fetchall()
+            connection.execute("SELECT chat_id, subscribed_at FROM subscribers LIMIT 1").fetchall()
+        finally:
+            connection.close()
+
+    # Скачивает файл в temp-файл рядом с базой; возвращает (путь, sha256, заголовки)
+    # или None, если файл не изменился
+    async def _download(self, meta):
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        loop = asyncio.get_running_loop()
+        async with aiohttp.ClientSession(timeout=self.timeout) as session:
+            async with session.get(self.url, headers=headers) as response:
+                if response.status == 304:
+                    logger.info("База данных в облаке не изменилась (304).")
+                    return None
+                response.raise_for_status()
+
+                fd, temp_path = tempfile.mkstemp(
+                    prefix=".download-", suffix=".db", dir=os.path.dirname(os.path.abspath(self.path))
+                )
+                digest = hashlib.sha256()
+                header = b""
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            if len(header) < len(self.SQLITE_HEADER):
+                                header += chunk[:len(self.SQLITE_HEADER) - len(header)]
+                                if len(header) == len(self.SQLITE_HEADER) and header != self.SQLITE_HEADER:
+                                    raise ValueError(f"файл не является базой SQLite (начало: {header!r})")
+                            digest.update(chunk)
+                            await loop.run_in_executor(None, f.write, chunk)
+                    if header != self.SQLITE_HEADER:
+                        raise ValueError("файл слишком короткий для базы SQLite")
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+                return temp_path, digest.hexdigest(), {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+
+    # Одна попытка синхронизации; возвращает True, если файл базы был заменён
+    async def sync(self):
+        async with self.lock:
+            logger.info("Синхронизация базы данных с %s...", self.url)
+            meta = self._load_meta()
+            try:
+                downloaded = await self._download(meta)
+            except Exception as e:
+                logger.warning("Ошибка при скачивании базы данных: %s", e)
+                return False
+            if downloaded is None:
+                return False
+
+            temp_path, sha256, new_meta = downloaded
+            loop = asyncio.get_running_loop()
+            try:
+                if self.expected_sha256 and sha256 != self.expected_sha256:
+                    raise ValueError(f"контрольная сумма {sha256} не совпадает с ожидаемой")
+                await loop.run_in_executor(None, self._check_database, temp_path)
+                current_sha256 = meta.get("sha256") or await loop.run_in_executor(None, self._file_sha256, self.path)
+                if sha256 == current_sha256:
+                    logger.info("Скачанная база совпадает с локальной, замена не нужна.")
+                    os.remove(temp_path)
+                    self._save_meta({**new_meta, "sha256": sha256})
+                    return False
+            except Exception as e:
+                logger.warning("Скачанный файл отклонён: %s", e, extra=log_fields(sha256=sha256))
+                os.remove(temp_path)
+                return False
+
+            try:
+                await db.replace_file(temp_path)
+            except Exception as e:
+                logger.error("Не удалось заменить базу данных скачанной, оставлена прежняя: %s", e, extra=log_fields(sha256=sha256))
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return False
+            self._save_meta({**new_meta, "sha256": sha256})
+            await catalog.reload(db.all_characters)
+            logger.info("База данных обновлена из облака (sha256 %s).", sha256[:12], extra=log_fields(sha256=sha256))
+            return True
+
+    # Периодическое фоновое обновление
+    async def run_periodic(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.sync()
+
+database_sync = DatabaseSync(DATABASE_URL, database_file, os.getenv("DATABASE_SHA256")) if DATABASE_URL else None
 
-# Проверяем валидность базы данных
-initialize_database()
 
 # Создание главного меню с кнопками
 menu = InlineKeyboardMarkup(inline_keyboard=[
@@ -135,26 +1662,85 @@ menu = InlineKeyboardMarkup(inline_keyboard=[
 # Команда /start
 @dp.message(CommandStart())
 async def start(message: types.Message, state: FSMContext):
-    print(f"Получена команда /start от пользователя {message.from_user.id}")
+    logger.info("Получена команда /start от пользователя %s", message.from_user.id, extra=log_fields(user_id=message.from_user.id))
     await state.clear()  # Сбрасываем состояние, если оно есть
     await message.reply("🦸 Привет! Я бот канала КомиксХаб! Помогу найти героев комиксов. Выбери действие:", reply_markup=menu)
 
 # Команда /cancel для выхода из режима поиска
 @dp.message(Command(commands=["cancel"]))
 async def cancel(message: types.Message, state: FSMContext):
-    print(f"Получена команда /cancel от пользователя {message.from_user.id}")
+    logger.info("Получена команда /cancel от пользователя %s", message.from_user.id, extra=log_fields(user_id=message.from_user.id))
     await state.clear()
     await message.reply("Поиск завершён. Используй /start, чтобы начать заново. 😊")
 
+# Команда /random [издатель или тип]
+@dp.message(Command(commands=["random"]))
+async def random_command(message: types.Message, command: CommandObject):
+    logger.debug("Получена команда /random от пользователя %s", message.from_user.id,
+                 extra=log_fields(user_id=message.from_user.id, filter=command.args))
+    await send_random_character(message, command.args)
+
+# Команды /subscribe и /unsubscribe: рассылка о новых персонажах
+@dp.message(Command(commands=["subscribe"]))
+async def subscribe(message: types.Message):
+    await db.execute("INSERT OR IGNORE INTO subscribers (chat_id, subscribed_at) VALUES (?, ?)",
+                     (message.chat.id, int(time.time())))
+    await message.reply("Готово! Буду присылать новых персонажей сразу после добавления. 🔔\nОтписаться: /unsubscribe")
+    logger.info("Чат %s подписался на рассылку", message.chat.id, extra=log_fields(chat_id=message.chat.id))
+
+@dp.message(Command(commands=["unsubscribe"]))
+async def unsubscribe(message: types.Message):
+    await db.execute("DELETE FROM subscribers WHERE chat_id = ?", (message.chat.id,))
+    await message.reply("Подписка отменена. Вернуться: /subscribe")
+    logger.info("Чат %s отписался от рассылки", message.chat.id, extra=log_fields(chat_id=message.chat.id))
+
+# Рассылка карточки нового персонажа подписчикам в очереди LOW:
+# BROADCAST_CONCURRENCY отправок одновременно, темп задаёт планировщик.
+# Чаты, которые заблокировали бота, удаляются из подписчиков.
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 50))
+broadcast_tasks = set()
+
+async def broadcast_character(rowid, report_chat_id=None):
+    send_priority.set(SendScheduler.LOW)
+    text, buttons = card_cache.get(rowid)
+    text = f"🆕 Новый персонаж в каталоге!\n\n{text}"
+    chat_ids = iter([chat_id for (chat_id,) in await db.fetchall("SELECT chat_id FROM subscribers")])
+    results = Counter()
+
+    async def worker():
+        for chat_id in chat_ids:
+            try:
+                await bot.send_message(chat_id, text, reply_markup=buttons)
+                result = "delivered"
+            except TelegramForbiddenError:
+                await db.execute("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+                result = "unsubscribed"
+            except Exception as e:
+                logger.warning("Рассылка: не удалось отправить в чат %s: %s", chat_id, e, extra=log_fields(chat_id=chat_id, rowid=rowid))
+                result = "failed"
+            results[result] += 1
+            metrics.inc("broadcast_messages_total", result=result)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    elapsed = time.perf_counter() - started
+    logger.info("Рассылка персонажа %s завершена за %.1f с: доставлено %d, отписано %d, ошибок %d",
+                rowid, elapsed, results["delivered"], results["unsubscribed"], results["failed"],
+                extra=log_fields(rowid=rowid, seconds=round(elapsed, 3), **results))
+    if report_chat_id is not None:
+        await bot.send_message(report_chat_id, f"Рассылка завершена: доставлено {results['delivered']}, "
+                                               f"отписались {results['unsubscribed']}, ошибок {results['failed']}.")
+
 # Команда /addcharacter (только для администратора)
 @dp.message(Command(commands=["addcharacter"]))
 async def add_character_start(message: types.Message, state: FSMContext):
     admin_id = 376742720  # Твой Telegram ID
     if message.from_user.id != admin_id:
-        print(f"Пользователь {message.from_user.id} попытался использовать /addcharacter, но доступ запрещён")
+        logger.warning("Пользователь %s попытался использовать /addcharacter, но доступ запрещён", message.from_user.id,
+                       extra=log_fields(user_id=message.from_user.id))
         return  # Игнорируем команду, если пользователь не администратор
 
-    print(f"Получена команда /addcharacter от администратора {message.from_user.id}")
+    logger.info("Получена команда /addcharacter от администратора %s", message.from_user.id, extra=log_fields(user_id=message.from_user.id))
     await state.clear()  # Сбрасываем состояние
     await state.set_state(AddCharacterStates.waiting_for_name)
     await message.reply("Введите имя персонажа (например, Человек-паук Нуар):")
@@ -249,147 +1835,440 @@ async def process_art_link(message: types.Message, state: FSMContext):
 
     # Сохраняем персонажа в базу данных
     try:
-        cursor.execute("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)",
-                       (name, publisher, universe, type_, description, post_link, art_link))
-        conn.commit()
+        row = (name, publisher, universe, type_, description, post_link, art_link)
+        rowid = await db.insert_character(row)
+        catalog.add(rowid, row)
         await message.reply(f"Персонаж {name} успешно добавлен! 🎉")
-        print(f"Администратор {message.from_user.id} добавил персонажа: {name}")
+        logger.info("Администратор %s добавил персонажа: %s", message.from_user.id, name,
+                    extra=log_fields(user_id=message.from_user.id, rowid=rowid, name=name))
+        task = asyncio.create_task(broadcast_character(rowid, report_chat_id=message.chat.id))
+        broadcast_tasks.add(task)
+        task.add_done_callback(broadcast_tasks.discard)
     except Exception as e:
         await message.reply(f"Ошибка при добавлении персонажа: {e}")
-        print(f"Ошибка при добавлении персонажа администратором {message.from_user.id}: {e}")
+        logger.error("Ошибка при добавлении персонажа администратором %s: %s", message.from_user.id, e,
+                     extra=log_fields(user_id=message.from_user.id, name=name))
+
+    await state.clear()
+
+# Массовый импорт и экспорт каталога (только для администратора)
+CHARACTER_COLUMNS = CHARACTER_FIELDS.split(", ")
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_REPORTED_ERRORS = 20
+
+# Построчное чтение CSV (с заголовком) или JSONL: (номер строки, словарь или ошибка).
+# Битые байты UTF-8 (surrogateescape) и ошибки разбора CSV становятся ошибками
+# отдельных строк, а не прерывают импорт на середине
+def read_import_rows(path, file_format):
+    with open(path, encoding="utf-8-sig", errors="surrogateescape", newline="") as f:
+        if file_format == "csv":
+            reader = csv.DictReader(f)
+            missing = [column for column in ("name", "art_link") if column not in (reader.fieldnames or [])]
+            if missing:
+                raise ValueError(f"в заголовке CSV нет столбцов: {', '.join(missing)}")
+            while True:
+                try:
+                    record = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error as e:
+                    yield reader.line_num, f"некорректная строка CSV: {e}"
+                    continue
+                values = [value for value in record.values() if isinstance(value, str)]
+                yield reader.line_num, "некорректная кодировка, нужен UTF-8" if has_undecodable(values) else record
+        else:
+            for line_num, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                if has_undecodable([line]):
+                    yield line_num, "некорректная кодировка, нужен UTF-8"
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield line_num, f"некорректный JSON: {e}"
+                    continue
+                yield line_num, record if isinstance(record, dict) else "ожидался JSON-объект"
+
+def has_undecodable(values):
+    return any("\udc80" <= char <= "\udcff" for value in values for char in value)
+
+# Проверка одной записи; возвращает кортеж для INSERT
+def validate_import_record(record):
+    row = tuple(str(record.get(column) or "").strip() for column in CHARACTER_COLUMNS)
+    name, art_link = row[0], row[6]
+    if not name:
+        raise ValueError("пустое имя")
+    if not art_link.startswith(("http://", "https://")):
+        raise ValueError(f"art_link должен быть http(s)-ссылкой: {art_link!r}")
+    return row
+
+# Выполняется в потоке писателя: вставка пачками executemany, каждая пачка — своя транзакция.
+# Если чтение или запись обрываются, незакоммиченная пачка откатывается, а в отчёт
+# попадают уже закоммиченные строки и причина остановки
+def import_characters_file(connection, path, file_format):
+    imported = 0
+    errors = []
+    chunk = []
+    line_num = 0
+    sql = f"INSERT INTO characters ({CHARACTER_FIELDS}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    try:
+        for line_num, record in read_import_rows(path, file_format):
+            try:
+                if isinstance(record, str):
+                    raise ValueError(record)
+                chunk.append(validate_import_record(record))
+            except ValueError as e:
+                errors.append((line_num, str(e)))
+                continue
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                connection.executemany(sql, chunk)
+                connection.commit()
+                imported += len(chunk)
+                chunk = []
+        if chunk:
+            connection.executemany(sql, chunk)
+            connection.commit()
+            imported += len(chunk)
+    except Exception as e:
+        connection.rollback()
+        errors.append((line_num, f"импорт остановлен, следующие строки не загружены: {e}"))
+    return imported, errors
+
+# Выполняется в читающем потоке: построчная запись всего каталога во временный файл
+def export_characters_file(connection, path, file_format):
+    count = 0
+    cursor = connection.execute(f"SELECT {CHARACTER_FIELDS} FROM characters ORDER BY id")
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if file_format == "csv" else None
+        if writer:
+            writer.writerow(CHARACTER_COLUMNS)
+        while True:
+            rows = cursor.fetchmany(IMPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                if writer:
+                    writer.writerow(row)
+                else:
+                    f.write(json.dumps(dict(zip(CHARACTER_COLUMNS, row)), ensure_ascii=False) + "\n")
+            count += len(rows)
+    return count
+
+# Команда /import: ждём CSV или JSONL документ
+@dp.message(Command(commands=["import"]))
+async def import_start(message: types.Message, state: FSMContext):
+    admin_id = 376742720
+    if message.from_user.id != admin_id:
+        logger.warning("Пользователь %s попытался использовать /import, но доступ запрещён", message.from_user.id,
+                       extra=log_fields(user_id=message.from_user.id))
+        return
 
+    logger.info("Получена команда /import от администратора %s", message.from_user.id, extra=log_fields(user_id=message.from_user.id))
     await state.clear()
+    await state.set_state(ImportStates.waiting_for_file)
+    await message.reply(
+        "Отправьте файл .csv (с заголовком name,publisher,universe,type,description,post_link,art_link) "
+        "или .jsonl (по одному JSON-объекту с теми же полями в строке). /cancel — отмена."
+    )
+
+# Обработка загруженного файла импорта
+@dp.message(ImportStates.waiting_for_file, F.document)
+async def process_import_file(message: types.Message, state: FSMContext):
+    admin_id = 376742720
+    if message.from_user.id != admin_id:
+        return
+
+    file_name = message.document.file_name or ""
+    extension = os.path.splitext(file_name)[1].lower()
+    file_format = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}.get(extension)
+    if file_format is None:
+        await message.reply("Нужен файл с расширением .csv или .jsonl.")
+        return
+
+    await state.clear()
+    fd, temp_path = tempfile.mkstemp(prefix=".import-", suffix=extension)
+    os.close(fd)
+    try:
+        await bot.download(message.document, destination=temp_path)
+        imported, errors = await db.write(import_characters_file, temp_path, file_format)
+    except Exception as e:
+        await message.reply(f"Ошибка при импорте: {e}")
+        logger.error("Ошибка при импорте файла %s администратором %s: %s", file_name, message.from_user.id, e,
+                     extra=log_fields(user_id=message.from_user.id, file=file_name))
+        return
+    finally:
+        os.remove(temp_path)
+        # Производные структуры (индекс, кэши, случайный выбор) перестраиваются один раз,
+        # даже если импорт прервался: часть пачек уже могла попасть в базу
+        await catalog.reload(db.all_characters)
+
+    report = [f"Импортировано персонажей: {imported}. Ошибок: {len(errors)}."]
+    report += [f"Строка {line_num}: {error}" for line_num, error in errors[:IMPORT_MAX_REPORTED_ERRORS]]
+    if len(errors) > IMPORT_MAX_REPORTED_ERRORS:
+        report.append(f"…и ещё {len(errors) - IMPORT_MAX_REPORTED_ERRORS}")
+    await message.reply("\n".join(report))
+    logger.info("Администратор %s импортировал %d персонажей из %s, ошибок: %d", message.from_user.id, imported, file_name, len(errors),
+                extra=log_fields(user_id=message.from_user.id, file=file_name, imported=imported, errors=len(errors)))
+
+@dp.message(ImportStates.waiting_for_file)
+async def process_import_not_file(message: types.Message):
+    admin_id = 376742720
+    if message.from_user.id != admin_id:
+        return
+    await message.reply("Пришлите файл .csv или .jsonl документом или /cancel для отмены.")
+
+# Команда /export [csv|jsonl]: выгрузка всего каталога файлом
+@dp.message(Command(commands=["export"]))
+async def export_catalog(message: types.Message, command: CommandObject):
+    admin_id = 376742720
+    if message.from_user.id != admin_id:
+        logger.warning("Пользователь %s попытался использовать /export, но доступ запрещён", message.from_user.id,
+                       extra=log_fields(user_id=message.from_user.id))
+        return
+
+    file_format = (command.args or "csv").strip().lower()
+    if file_format not in ("csv", "jsonl"):
+        await message.reply("Формат экспорта: csv или jsonl, например /export jsonl")
+        return
+
+    fd, temp_path = tempfile.mkstemp(prefix=".export-", suffix=f".{file_format}")
+    os.close(fd)
+    try:
+        count = await db.read(export_characters_file, temp_path, file_format)
+        await message.reply_document(FSInputFile(temp_path, filename=f"characters.{file_format}"),
+                                     caption=f"Персонажей в каталоге: {count}")
+        logger.info("Администратор %s выгрузил %d персонажей (%s)", message.from_user.id, count, file_format,
+                    extra=log_fields(user_id=message.from_user.id, exported=count, format=file_format))
+    except Exception as e:
+        await message.reply(f"Ошибка при экспорте: {e}")
+        logger.error("Ошибка при экспорте каталога: %s", e, extra=log_fields(user_id=message.from_user.id, format=file_format))
+    finally:
+        os.remove(temp_path)
 
 # Обработка кнопок главного меню
-@dp.callback_query()
+@dp.callback_query(F.data.in_({"search", "random"}))
 async def handle_buttons(callback_query: types.CallbackQuery, state: FSMContext):
     data = callback_query.data
-    print(f"Пользователь {callback_query.from_user.id} нажал кнопку: {data}")
+    logger.debug("Пользователь %s нажал кнопку: %s", callback_query.from_user.id, data,
+                 extra=log_fields(user_id=callback_query.from_user.id, button=data))
     await callback_query.answer()
 
     if data == "search":
         await callback_query.message.reply("Введи запрос (например, паук, нуар, Marvel):")
         await state.set_state(SearchStates.waiting_for_query)
-        print(f"Пользователь {callback_query.from_user.id} перешёл в режим поиска")
+        logger.debug("Пользователь %s перешёл в режим поиска", callback_query.from_user.id)
     elif data == "random":
-        print(f"Выполняется запрос на случайного персонажа...")
-        ensure_database_populated()  # Перезаполняем базу перед запросом
-        cursor.execute("SELECT * FROM characters ORDER BY RANDOM() LIMIT 1")
-        result = cursor.fetchone()
-        if result:
-            name, publisher, universe, type_, desc, link, art = result
-            buttons = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Арт", url=art)]
-            ])
-            await callback_query.message.reply(
-                f"🦸 {name}\n📚 Издатель: {publisher}\n🌌 Вселенная: {universe}\n🦸 Тип: {type_}\n📖 {desc}\n📜 Пост: {link}",
-                reply_markup=buttons
-            )
-            print(f"Случайный персонаж найден: {name}")
-        else:
-            await callback_query.message.reply("Персонажи не найдены. База данных пуста. 😔")
-            print("Случайный персонаж не найден: база данных пуста")
+        await send_random_character(callback_query.message)
+
+# Отправка случайного персонажа, при необходимости с фильтром по издателю или типу
+async def send_random_character(message: types.Message, value=None):
+    logger.debug("Выполняется запрос на случайного персонажа (фильтр: %s)...", value)
+    rowid = random_picker.pick(value)
+    card = card_cache.get(rowid) if rowid is not None else None
+    if card:
+        text, buttons = card
+        await message.reply(text, reply_markup=buttons)
+        logger.debug("Случайный персонаж найден: %s", rowid, extra=log_fields(chat_id=message.chat.id, rowid=rowid, filter=value))
+    elif value:
+        await message.reply(f"Нет персонажей с издателем или типом «{value}». 😔")
+        logger.info("Случайный персонаж не найден для фильтра %s", value, extra=log_fields(filter=value))
+    else:
+        await message.reply("Персонажи не найдены. База данных пуста. 😔")
+        logger.info("Случайный персонаж не найден: база данных пуста")
+
+INLINE_PAGE_SIZE = 20
+
+# Inline-режим (@bot запрос): тот же нечёткий поиск, ответ страницами через next_offset.
+# Должен быть включён у бота через /setinline в BotFather.
+@dp.inline_query()
+async def handle_inline_query(inline_query: types.InlineQuery):
+    query, query_parts = normalize_query(inline_query.query)
+    if not query_parts:
+        await inline_query.answer([], cache_time=60)
+        return
+
+    try:
+        matches = await search_characters(query, query_parts)
+    except SearchOverloadedError as e:
+        logger.warning("Inline-запрос пользователя %s отклонён, %s", inline_query.from_user.id, e,
+                       extra=log_fields(user_id=inline_query.from_user.id, query=query))
+        await inline_query.answer([], cache_time=1, is_personal=True)
+        return
+    ids = [rowid for rowid, _ in matches]
+
+    try:
+        offset = max(0, int(inline_query.offset or 0))
+    except ValueError:
+        offset = 0
+    results = []
+    for rowid in ids[offset:offset + INLINE_PAGE_SIZE]:
+        row = catalog.get(rowid)
+        if row is None:
+            continue
+        text, buttons = card_cache.get(rowid)
+        name, publisher, universe, type_ = row[:4]
+        results.append(InlineQueryResultArticle(
+            id=str(rowid),
+            title=name,
+            description=f"{publisher} · {universe} · {type_}",
+            input_message_content=InputTextMessageContent(message_text=text),
+            reply_markup=buttons,
+        ))
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(ids) else ""
+    await inline_query.answer(results, cache_time=300, next_offset=next_offset)
+    logger.debug("Inline-запрос %r: найдено %d, отдано с позиции %d", query, len(ids), offset,
+                 extra=log_fields(user_id=inline_query.from_user.id, query=query, found=len(ids), offset=offset))
+
+# Постраничный вывод результатов: токен -> ранжированный список id.
+# С FSM_STORAGE=sqlite списки пишутся и в файл хранилища, чтобы ◀/▶ работали
+# в любом воркере; локальный кэш избавляет от чтения файла в том же процессе
+class ResultPages:
+    def __init__(self, storage, maxsize=10000, ttl=3600):
+        self.storage = storage if isinstance(storage, SqliteStorage) else None
+        self.ttl = ttl
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def set(self, token, ids):
+        self.cache.set(token, ids)
+        if self.storage is None:
+            return
+        try:
+            await self.storage.set_page(token, ids, self.ttl)
+        except Exception as e:
+            # Листание продолжит работать хотя бы в этом воркере
+            logger.error("Ошибка записи страницы результатов: %s", e, extra=log_fields(token=token))
+
+    async def get(self, token):
+        ids = self.cache.get(token)
+        if ids is None and self.storage is not None:
+            ids = await self.storage.get_page(token)
+            if ids is not None:
+                self.cache.set(token, ids)
+        return ids
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 8))
+result_pages = ResultPages(storage, maxsize=int(os.getenv("RESULT_PAGES_SIZE", 10000)), ttl=int(os.getenv("RESULT_PAGES_TTL", 3600)))
+
+# Текст и клавиатура страницы результатов (кнопки «◀»/«▶» листают страницы)
+def results_page(token, ids, page):
+    pages = (len(ids) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    rows = []
+    for rowid in ids[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]:
+        character = catalog.get(rowid)
+        if character is not None:
+            rows.append([InlineKeyboardButton(text=f"{character[0]} ({character[1]})", callback_data=f"sel:{rowid}")])
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀", callback_data=f"page:{token}:{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton(text="▶", callback_data=f"page:{token}:{page + 1}"))
+    if navigation:
+        rows.append(navigation)
+    text = "Найдено несколько персонажей. Выбери одного:"
+    if pages > 1:
+        text = f"Найдено персонажей: {len(ids)} (страница {page + 1} из {pages}). Выбери одного:"
+    return text, InlineKeyboardMarkup(inline_keyboard=rows)
 
 # Обработка текстовых сообщений (поиск в личных чатах)
 @dp.message(SearchStates.waiting_for_query)
 async def handle_search_query(message: types.Message, state: FSMContext):
-    print(f"Пользователь {message.from_user.id} отправил запрос в состоянии waiting_for_query")
-    query = message.text.lower().strip().replace("-", " ").replace("  ", " ")  # Убираем лишние пробелы и дефисы
-    query_parts = query.split()  # Разбиваем запрос на слова
-    print(f"Запрос пользователя {message.from_user.id}: {query} (разбит на части: {query_parts})")
-
-    # Перезаполняем базу перед запросом
-    ensure_database_populated()
-
-    # Получаем все записи из базы данных
-    cursor.execute("SELECT * FROM characters")
-    all_characters = cursor.fetchall()
-    print(f"Все персонажи в базе: {all_characters}")
-    results = []
+    query, query_parts = normalize_query(message.text)
+    logger.debug("Запрос пользователя %s: %s (разбит на части: %s)", message.from_user.id, query, query_parts,
+                 extra=log_fields(user_id=message.from_user.id, query=query))
 
-    # Нечёткий поиск: проверяем каждую запись
-    for character in all_characters:
-        name, publisher, universe, type_, desc, link, art = character
-        combined_text = f"{name} {publisher} {universe} {type_}".lower()
-        max_score = 0
-        for part in query_parts:
-            score = fuzz.partial_ratio(part, combined_text)
-            print(f"Сравниваем '{part}' с '{combined_text}': score={score}")
-            if score > max_score:
-                max_score = score
-        if max_score >= 50:  # Порог уже снижен до 50
-            results.append(character)
-            print(f"Персонаж {name} найден с уровнем сходства {max_score}%")
-
-    print(f"Найдено записей: {len(results)}")
-    print(f"Результаты: {results}")
-
-    if results:
-        if len(results) == 1:
-            name, publisher, universe, type_, desc, link, art = results[0]
-            buttons = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Арт", url=art)]
-            ])
-            await message.reply(
-                f"🦸 {name}\n📚 Издатель: {publisher}\n🌌 Вселенная: {universe}\n🦸 Тип: {type_}\n📖 {desc}\n📜 Пост: {link}",
-                reply_markup=buttons
-            )
-            print(f"Пользователь {message.from_user.id}: найден 1 персонаж: {name}")
+    # Поиск движком search_engine (rapidfuzz по всему каталогу или FTS) через кэш результатов
+    try:
+        matches = await search_characters(query, query_parts)
+    except SearchOverloadedError as e:
+        logger.warning("Пользователь %s: поиск отклонён, %s", message.from_user.id, e,
+                       extra=log_fields(user_id=message.from_user.id, query=query))
+        await message.reply("Сейчас слишком много запросов, попробуй через пару секунд. ⏳")
+        return
+
+    ids = [rowid for rowid, _ in matches if catalog.get(rowid) is not None]
+    logger.debug("Найдено записей: %d", len(ids), extra=log_fields(user_id=message.from_user.id, query=query, found=len(ids)))
+
+    if ids:
+        if len(ids) == 1:
+            text, buttons = card_cache.get(ids[0])
+            await message.reply(text, reply_markup=buttons)
+            logger.debug("Пользователь %s: найден 1 персонаж: %s", message.from_user.id, ids[0])
         else:
-            buttons = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=f"{result[0]} ({result[1]})", callback_data=f"select_{result[0]}")] for result in results
-            ])
-            await message.reply("Найдено несколько персонажей. Выбери одного:", reply_markup=buttons)
-            print(f"Пользователь {message.from_user.id}: найдено несколько персонажей: {[result[0] for result in results]}")
+            # Ранжированный список хранится на сервере, страницы листаются по токену
+            token = secrets.token_hex(8)
+            await result_pages.set(token, ids)
+            text, buttons = results_page(token, ids, 0)
+            await message.reply(text, reply_markup=buttons)
+            logger.debug("Пользователь %s: найдено несколько персонажей: %d", message.from_user.id, len(ids))
     else:
         await message.reply("Персонаж не найден! Попробуй другой запрос. 😎")
-        print(f"Пользователь {message.from_user.id}: персонажи не найдены для запроса '{query}'")
+        logger.debug("Пользователь %s: персонажи не найдены для запроса '%s'", message.from_user.id, query)
 
     # Сбрасываем состояние после обработки
     await state.clear()
-    print(f"Пользователь {message.from_user.id}: состояние сброшено, текущее состояние: {await state.get_state()}")
+    logger.debug("Пользователь %s: состояние сброшено", message.from_user.id)
+
+# Листание страниц результатов: редактируем сообщение, поиск не повторяется
+@dp.callback_query(F.data.startswith("page:"))
+async def handle_results_page(callback_query: types.CallbackQuery):
+    parts = callback_query.data.split(":")
+    ids = await result_pages.get(parts[1]) if len(parts) == 3 and parts[2].isdigit() else None
+    if ids is None:
+        await callback_query.answer("Результаты поиска устарели, повтори поиск. 🔍", show_alert=True)
+        return
+    text, buttons = results_page(parts[1], ids, int(parts[2]))
+    try:
+        await callback_query.message.edit_text(text, reply_markup=buttons)
+    except TelegramBadRequest as e:
+        # Повторное нажатие той же кнопки: страница уже показана
+        if "message is not modified" not in e.message:
+            raise
+    finally:
+        await callback_query.answer()
 
 # Обработка выбора персонажа из списка
-@dp.callback_query(lambda c: c.data.startswith("select_"))
+@dp.callback_query(F.data.startswith("sel:") | F.data.startswith("select_"))
 async def handle_selection(callback_query: types.CallbackQuery):
-    print(f"Функция handle_selection вызвана для callback_query: {callback_query}")
-    selected_name = callback_query.data.split("_", 1)[1]  # Исправляем split, чтобы обработать имена с пробелами
-    print(f"Пользователь {callback_query.from_user.id} выбрал персонажа: {selected_name}")
+    data = callback_query.data
+    if data.startswith("sel:"):
+        selected = data.split(":", 1)[1]
+        character_id = int(selected) if selected.isdigit() else None
+    else:
+        # Кнопки старого формата select_<имя> в уже отправленных сообщениях
+        selected = data.split("_", 1)[1]
+        character_id = catalog.id_by_name(selected)
+    logger.debug("Пользователь %s выбрал персонажа: %s", callback_query.from_user.id, selected,
+                 extra=log_fields(user_id=callback_query.from_user.id, rowid=character_id))
     try:
-        # Перезаполняем базу перед запросом
-        ensure_database_populated()
-
-        # Проверяем содержимое базы данных перед запросом
-        cursor.execute("SELECT * FROM characters")
-        all_characters = cursor.fetchall()
-        print(f"Все персонажи в базе перед выбором: {all_characters}")
-
-        # Ищем персонажа
-        cursor.execute("SELECT * FROM characters WHERE name = ?", (selected_name,))
-        result = cursor.fetchone()
-        print(f"Результат запроса к базе данных: {result}")
-        if result:
-            name, publisher, universe, type_, desc, link, art = result
-            buttons = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Арт", url=art)]
-            ])
+        # Ищем персонажа по id в снимке каталога, при промахе — одним запросом по первичному ключу
+        card = None
+        if character_id is not None:
+            card = card_cache.get(character_id)
+            if card is None:
+                row = await db.character_by_id(character_id)
+                if row:
+                    catalog.add(character_id, row)
+                    card = card_cache.get(character_id)
+        if card:
+            text, buttons = card
             try:
-                await callback_query.message.reply(
-                    f"🦸 {name}\n📚 Издатель: {publisher}\n🌌 Вселенная: {universe}\n🦸 Тип: {type_}\n📖 {desc}\n📜 Пост: {link}",
-                    reply_markup=buttons
-                )
-                print(f"Пользователь {callback_query.from_user.id}: информация о персонаже {name} отправлена")
+                await callback_query.message.reply(text, reply_markup=buttons)
+                logger.debug("Пользователь %s: информация о персонаже %s отправлена", callback_query.from_user.id, selected)
             except Exception as send_error:
-                print(f"Ошибка при отправке сообщения в Telegram: {send_error}")
+                logger.error("Ошибка при отправке сообщения в Telegram: %s", send_error,
+                             extra=log_fields(user_id=callback_query.from_user.id, rowid=character_id))
                 await callback_query.message.reply(f"Не удалось отправить информацию: {send_error}")
         else:
             await callback_query.message.reply("Персонаж не найден в базе данных. 😔")
-            print(f"Пользователь {callback_query.from_user.id}: персонаж {selected_name} не найден в базе данных")
+            logger.debug("Пользователь %s: персонаж %s не найден в базе данных", callback_query.from_user.id, selected)
     except Exception as db_error:
-        print(f"Ошибка при запросе к базе данных: {db_error}")
+        logger.error("Ошибка при запросе к базе данных: %s", db_error,
+                     extra=log_fields(user_id=callback_query.from_user.id, rowid=character_id))
         await callback_query.message.reply(f"Произошла ошибка при доступе к базе данных: {db_error}")
     finally:
-        print(f"Завершение обработки callback_query для пользователя {callback_query.from_user.id}")
+        logger.debug("Завершение обработки callback_query для пользователя %s", callback_query.from_user.id)
     await callback_query.answer()
 
 # Обработка текстовых сообщений, когда пользователь не в режиме поиска
@@ -397,45 +2276,307 @@ async def handle_selection(callback_query: types.CallbackQuery):
 async def handle_text(message: types.Message, state: FSMContext):
     # Игнорируем пустые сообщения или сообщения без текста
     if not message.text:
-        print(f"Сообщение пользователя {message.from_user.id} проигнорировано: текст отсутствует")
+        logger.debug("Сообщение пользователя %s проигнорировано: текст отсутствует", message.from_user.id)
         return
 
-    print(f"Пользователь {message.from_user.id} ввёл текст: {message.text}")
     # Игнорируем сообщения в группах
     if message.chat.type in ["group", "supergroup"]:
-        print(f"Сообщение пользователя {message.from_user.id} в группе проигнорировано: {message.text}")
+        logger.debug("Сообщение пользователя %s в группе проигнорировано", message.from_user.id)
         return
 
-    print(f"Пользователь {message.from_user.id} ввёл текст вне режима поиска: {message.text}")
+    logger.debug("Пользователь %s ввёл текст вне режима поиска: %s", message.from_user.id, message.text)
     await message.reply("Введи запрос (например, паук, нуар, Marvel):")
     await state.set_state(SearchStates.waiting_for_query)
-    print(f"Пользователь {message.from_user.id} перешёл в режим поиска")
+    logger.debug("Пользователь %s перешёл в режим поиска", message.from_user.id)
 
 # Минимальный HTTP-сервер для health checks Render
 async def handle_health(request):
     return web.Response(text="The bot is running fine :)")
 
+# Метрики в текстовом формате Prometheus
+# При нескольких воркерах запрос /metrics попадает в случайный из них
+# (SO_REUSEPORT). Поэтому каждый воркер сохраняет снимок своих метрик в общий
+# каталог (раз в interval и при каждом запросе /metrics), а /metrics отдаёт
+# сумму снимков всех воркеров. Отданное значение каждого воркера к этому моменту
+# уже записано в его файл, поэтому следующий запрос, в каком бы воркере он ни
+# оказался, не покажет меньше. Снимки пишутся по порядку в одном потоке.
+class SharedMetrics:
+    def __init__(self, directory, worker_index):
+        self.directory = directory
+        self.path = os.path.join(directory, f"worker-{worker_index}.json")
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics")
+
+    def _write(self, text):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temp_path, self.path)
+
+    def _read_others(self):
+        snapshots = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".json") or path == self.path:
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning("Не удалось прочитать метрики воркера %s: %s", name, e)
+        return snapshots
+
+    def _exchange(self, text):
+        self._write(text)
+        return self._read_others()
+
+    async def save(self):
+        text = json.dumps(metrics.dump())
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._write, text)
+
+    async def run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save()
+            except OSError as e:
+                logger.error("Ошибка сохранения метрик воркера: %s", e)
+
+    async def render(self):
+        own = metrics.dump()
+        others = await asyncio.get_running_loop().run_in_executor(self.executor, self._exchange, json.dumps(own))
+        total = Metrics(metrics.prefix)
+        total.help = metrics.help
+        return total.merged([own, *others]).render()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+shared_metrics = None  # SharedMetrics при нескольких воркерах
+
+async def handle_metrics(request):
+    text = await shared_metrics.render() if shared_metrics else metrics.render()
+    return web.Response(text=text, content_type="text/plain", charset="utf-8",
+                        headers={"X-Prometheus-Format": "0.0.4"})
+
 # Настройка HTTP-сервера
 web_app = web.Application()
-web_app.add_routes([web.get('/healthcheck', handle_health)])
+web_app.add_routes([web.get('/healthcheck', handle_health), web.get('/metrics', handle_metrics)])
+
+# Режим получения апдейтов (BOT_MODE): polling или webhook на том же HTTP-сервере
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес сервера, например https://komikshub.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Без секрета aiogram принимает любой POST на WEBHOOK_PATH, и поддельный апдейт
+# дойдёт до команд администратора. Если WEBHOOK_SECRET не задан, генерируем
+# случайный и кладём в окружение, чтобы воркеры (spawn) получили тот же
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    WEBHOOK_SECRET = os.environ["WEBHOOK_SECRET"] = secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# Обработчик вебхука: сразу отвечает Telegram и обрабатывает апдейт в фоне,
+# но одновременно выполняется не больше max_in_flight обработчиков, а при
+# переполнении очереди возвращается 503, чтобы Telegram повторил доставку
+class BoundedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher, bot, max_in_flight, max_pending, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.max_pending = max_pending
 
-# Запуск polling и HTTP-сервера
-async def main():
-    # Удаляем вебхук перед запуском polling
-    print("Удаление существующего вебхука...")
-    await bot.delete_webhook(drop_pending_updates=True)
-    print("Вебхук удалён, запускаем polling...")
+    async def _background_feed_update(self, bot, update):
+        async with self.semaphore:
+            await super()._background_feed_update(bot, update)
 
-    # Запуск HTTP-сервера для health checks
+    async def _handle_request_background(self, bot, request):
+        if len(self._background_feed_update_tasks) >= self.max_pending:
+            metrics.inc("webhook_rejected_total")
+            return web.Response(status=503, text="Too many pending updates")
+        return await super()._handle_request_background(bot, request)
+
+metrics.describe("webhook_rejected_total", "counter", "Апдейты вебхука, отклонённые из-за переполнения очереди")
+
+async def set_webhook(bot: Bot):
+    if not WEBHOOK_URL:
+        logger.warning("WEBHOOK_URL не задан, вебхук в Telegram не устанавливается (локальный режим)")
+        return
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    await bot.set_webhook(
+        url,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=True,
+    )
+    logger.info("Вебхук установлен: %s", url)
+
+async def remove_webhook(bot: Bot):
+    if not WEBHOOK_URL:
+        return
+    await bot.delete_webhook()
+    logger.info("Вебхук удалён")
+
+# Вебхук в Telegram устанавливает и снимает только первый воркер
+def setup_webhook(primary=True):
+    handler = BoundedRequestHandler(
+        dp, bot,
+        max_in_flight=int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", 32)),
+        max_pending=int(os.getenv("WEBHOOK_MAX_PENDING", 1000)),
+        secret_token=WEBHOOK_SECRET,
+    )
+    handler.register(web_app, path=WEBHOOK_PATH)
+    if primary:
+        dp.startup.register(set_webhook)
+        dp.shutdown.register(remove_webhook)
+    setup_application(web_app, dp, bot=bot)
+
+# Подготовка базы: без локального файла ждём первую синхронизацию.
+# При нескольких воркерах выполняется один раз в родительском процессе.
+async def prepare_database():
+    have_local_copy = os.path.exists(database_file)
+    initialize_database()
+    db.open()
+    await ensure_database_populated()
+    if database_sync and not have_local_copy:
+        database_sync.reset()
+        await database_sync.sync()
+    return have_local_copy
+
+# Каталог могут изменить другие воркеры (/addcharacter, /import, синхронизация).
+# Изменённые id берутся из журнала catalog_changes и применяются точечно, свои
+# изменения уже есть в каталоге и пропускаются сравнением строк. Если журнал
+# неполон (замена файла) или изменений больше max_changes, каталог
+# перечитывается целиком в потоке.
+async def watch_catalog(version, interval, max_changes=1000):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            current = await db.catalog_version()
+            if current == version:
+                continue
+            ids = await db.catalog_changes(version, current, max_changes) if current > version else None
+            if ids is None:
+                await catalog.reload(db.all_characters)
+                logger.info("Каталог изменён другим процессом, перечитан целиком (версия %d)", current,
+                            extra=log_fields(catalog_version=current))
+            else:
+                rows = await db.characters_by_ids(ids)
+                applied = 0
+                for rowid in ids:
+                    row = rows.get(rowid)
+                    if row == catalog.get(rowid):
+                        continue
+                    catalog.remove(rowid)
+                    if row is not None:
+                        catalog.add(rowid, row)
+                    applied += 1
+                logger.debug("Каталог изменён другим процессом: применено %d из %d изменений (версия %d)",
+                             applied, len(ids), current, extra=log_fields(catalog_version=current, changes=applied))
+            version = current
+        except Exception as e:
+            logger.error("Ошибка при проверке версии каталога: %s", e)
+
+# Запуск бота (polling или webhook) и HTTP-сервера
+async def main(worker_index=0, metrics_dir=None):
+    global shared_metrics
+    primary = worker_index == 0
+    if BOT_MODE == "webhook":
+        setup_webhook(primary)
+    else:
+        # Удаляем вебхук перед запуском polling
+        logger.info("Удаление существующего вебхука...")
+        await bot.delete_webhook(drop_pending_updates=True)
+        logger.info("Вебхук удалён, запускаем polling...")
+
+    # С локальной копией базы работаем сразу и обновляемся в фоне
+    if WORKERS == 1:
+        have_local_copy = await prepare_database()
+    else:
+        have_local_copy = True
+        db.open()
+    use_fallback_search()
+    catalog_version = await db.catalog_version()
+    catalog.load(await db.all_characters())
+    background_tasks = []
+    if database_sync and primary:
+        if have_local_copy:
+            background_tasks.append(asyncio.create_task(database_sync.sync()))
+        refresh_interval = int(os.getenv("DATABASE_REFRESH_INTERVAL", 0))
+        if refresh_interval > 0:
+            background_tasks.append(asyncio.create_task(database_sync.run_periodic(refresh_interval)))
+    if metrics_dir:
+        shared_metrics = SharedMetrics(metrics_dir, worker_index)
+        background_tasks.append(asyncio.create_task(
+            shared_metrics.run(float(os.getenv("METRICS_SHARE_INTERVAL", 1)))))
+    if WORKERS > 1:
+        background_tasks.append(asyncio.create_task(
+            watch_catalog(catalog_version, float(os.getenv("CATALOG_POLL_INTERVAL", 1)),
+                          int(os.getenv("CATALOG_MAX_CHANGES", 1000)))))
+
+    # Запуск HTTP-сервера для health checks (воркеры делят порт через SO_REUSEPORT)
     runner = web.AppRunner(web_app)
     await runner.setup()
     port = int(os.getenv("PORT", 8000))
-    site = web.TCPSite(runner, '0.0.0.0', port)
+    site = web.TCPSite(runner, '0.0.0.0', port, reuse_port=True if WORKERS > 1 else None)
     await site.start()
-    print(f"HTTP server running on http://0.0.0.0:{port}")
+    logger.info("HTTP server running on http://0.0.0.0:%d (воркер %d из %d)", port, worker_index + 1, WORKERS,
+                extra=log_fields(worker=worker_index))
+
+    try:
+        if BOT_MODE == "webhook":
+            # Апдейты приходят через web_app, ждём SIGINT/SIGTERM
+            logger.info("Режим webhook: апдейты принимаются на %s", WEBHOOK_PATH)
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        for task in [*background_tasks, *broadcast_tasks]:
+            task.cancel()
+        send_scheduler.close()
+        await runner.cleanup()
+        if shared_metrics:
+            shared_metrics.close()
+        scoring_executor.shutdown()
+        db.close()
+
+def run_worker(worker_index, send_limits, metrics_dir):
+    setup_logging()
+    send_scheduler.use_limits(send_limits)
+    asyncio.run(main(worker_index, metrics_dir))
+
+# Несколько воркеров: база готовится один раз, затем запускаются процессы,
+# которые принимают вебхуки на общем порту. SIGTERM передаётся воркерам.
+def run_workers(count):
+    asyncio.run(prepare_database())
+    db.close()
+    if FSM_STORAGE != "sqlite":
+        logger.warning("FSM_STORAGE=memory при нескольких воркерах: состояния диалогов не общие")
+    metrics_dir = tempfile.mkdtemp(prefix="komikshub-metrics-")
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(index, send_scheduler.limits, metrics_dir), name=f"worker-{index}")
+               for index in range(count)]
+    for worker in workers:
+        worker.start()
+    logger.info("Запущено воркеров: %d", count, extra=log_fields(workers=count))
 
-    # Запуск polling
-    await dp.start_polling(bot)
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.join()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    setup_logging()
+    if BOT_MODE != "webhook" and int(os.getenv("WORKERS", 1)) > 1:
+        logger.warning("WORKERS > 1 поддерживается только в режиме webhook, polling запускается в одном процессе")
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        asyncio.run(main())
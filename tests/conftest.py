@@ -0,0 +1,47 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+# Настройки бота читаются при импорте модуля: база во временном каталоге,
+# без синхронизации с облаком и с FSM в памяти
+_workdir = tempfile.mkdtemp(prefix="komikshub-tests-")
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TESTStestsTESTStestsTESTStests")
+os.environ["DATABASE_URL"] = ""
+os.environ["DATABASE_FILE"] = os.path.join(_workdir, "characters.db")
+os.environ["FSM_STORAGE"] = "memory"
+os.environ.setdefault("SEARCH_WORKERS", "2")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+# Схема из первой версии бота: без первичного ключа, id — неявный rowid
+BASELINE_SCHEMA = '''CREATE TABLE characters
+                     (name TEXT, publisher TEXT, universe TEXT, type TEXT, description TEXT, post_link TEXT, art_link TEXT)'''
+
+
+# Строка таблицы characters (без id) для тестов
+def row(name, publisher="Marvel"):
+    return (name, publisher, "Земля-616", "Герой", "описание", "https://t.me/p/1", "https://example.com/a.jpg")
+
+
+# База первой версии с дырой в rowid: после миграции id должны совпасть со
+# старыми rowid, а не перенумероваться
+def baseline_database(path):
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute(BASELINE_SCHEMA)
+    connection.executemany("INSERT INTO characters VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [row("Паук"), row("Бэтмен", "DC"), row("Веном"), row("Джокер", "DC")])
+    connection.execute("DELETE FROM characters WHERE name = 'Бэтмен'")
+    return connection
+
+
+# Общая база модуля (k.db) открывается один раз: её пулы потоков
+# нельзя перезапустить после close()
+@pytest.fixture(scope="session")
+def database():
+    import komikshub_bot as k
+    k.db.open()
+    yield k.db
+    k.db.close()
@@ -0,0 +1,85 @@
+import asyncio
+
+import komikshub_bot as k
+
+from conftest import row
+
+
+def cached_queries(cache):
+    return sorted(cache.data)
+
+
+def test_query_cache_drops_only_affected_queries(monkeypatch):
+    monkeypatch.setattr(k, "search_engine", k.SearchIndex(threshold=50))
+    cache = k.QueryCache(maxsize=10, ttl=60)
+    cache.set("бэтмен", [(3, 100.0)])
+    cache.set("паук", [(1, 100.0), (2, 75.0)])
+    cache.set("шторм", [])
+
+    # Новый персонаж подходит только запросу «бэтмен»
+    assert k.search_engine.matches(["бэтмен"], row("Бэтмен Нуар", "DC"))
+    assert not any(k.search_engine.matches([query], row("Бэтмен Нуар", "DC")) for query in ("паук", "шторм"))
+    cache.add(5, row("Бэтмен Нуар", "DC"))
+    assert cached_queries(cache) == ["паук", "шторм"]
+
+    # Удаление сбрасывает только запросы, в результатах которых был персонаж
+    cache.remove(2)
+    assert cached_queries(cache) == ["шторм"]
+    cache.remove(42)
+    assert cached_queries(cache) == ["шторм"]
+
+    cache.install(cache.prepare([]))
+    assert len(cache) == 0
+
+
+def test_card_cache_rebuilds_only_changed_cards(monkeypatch):
+    cards = k.CardCache()
+    monkeypatch.setattr(k, "catalog", k.Catalog(listeners=[cards]))
+    k.catalog.load([(1, *row("Паук")), (2, *row("Веном"))])
+    first, second = cards.get(1), cards.get(2)
+    assert first[0].startswith("🦸 Паук\n")
+    assert cards.get(1) is first
+
+    k.catalog.remove(1)
+    k.catalog.add(1, row("Человек-паук"))
+    assert cards.get(1)[0].startswith("🦸 Человек-паук\n")
+    assert cards.get(2) is second
+
+    k.catalog.remove(2)
+    assert cards.get(2) is None
+
+    k.catalog.load([(1, *row("Паук"))])
+    assert cards.cards == {}
+
+
+class ChangingEngine:
+    def __init__(self):
+        self.calls = 0
+
+    def matches(self, query_parts, row):
+        return False
+
+    # Пока идёт поиск, другой обработчик добавляет персонажа
+    async def search(self, query_parts, limit):
+        self.calls += 1
+        if self.calls == 1:
+            k.catalog.add(7, row("Новый"))
+        return [(1, 100.0)]
+
+
+def test_search_result_is_not_cached_if_catalog_changed(monkeypatch):
+    engine = ChangingEngine()
+    monkeypatch.setattr(k, "search_engine", engine)
+    monkeypatch.setattr(k, "query_cache", k.QueryCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(k, "catalog", k.Catalog(listeners=[k.query_cache]))
+
+    async def run():
+        assert await k.search_characters("паук", ["паук"]) == [(1, 100.0)]
+        assert len(k.query_cache) == 0
+        # Каталог не менялся — результат кэшируется, повторный запрос не ищет
+        await k.search_characters("паук", ["паук"])
+        await k.search_characters("паук", ["паук"])
+
+    asyncio.run(run())
+    assert engine.calls == 2
+    assert cached_queries(k.query_cache) == ["паук"]
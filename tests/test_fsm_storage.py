@@ -0,0 +1,124 @@
+import asyncio
+import threading
+
+from aiogram.fsm.storage.base import StorageKey
+
+import komikshub_bot as k
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+OTHER_KEY = StorageKey(bot_id=1, chat_id=43, user_id=43)
+
+
+def test_states_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "fsm_state.db")
+
+    async def run():
+        first, second = k.SqliteStorage(path, flush_interval=0.01), k.SqliteStorage(path)
+        try:
+            await first.set_state(KEY, k.SearchStates.waiting_for_query)
+            await first.set_data(KEY, {"name": "Паук"})
+            await first.flush()
+            assert await second.get_state(KEY) == k.SearchStates.waiting_for_query.state
+            assert await second.get_data(KEY) == {"name": "Паук"}
+
+            # Сброшенное состояние удаляется из файла
+            await first.set_state(KEY, None)
+            await first.set_data(KEY, {})
+            await asyncio.sleep(0.1)
+            assert await second.get_state(KEY) is None
+            assert await second.get_data(KEY) == {}
+            assert first.connection.execute("SELECT COUNT(*) FROM fsm_states").fetchone()[0] == 0
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(run())
+
+
+def test_expired_states_are_not_read(tmp_path):
+    path = str(tmp_path / "fsm_state.db")
+
+    async def run():
+        expired, reader = k.SqliteStorage(path, ttl=-1), k.SqliteStorage(path)
+        try:
+            await expired.set_state(KEY, "AddCharacterStates:waiting_for_name")
+            await expired.flush()
+            assert await reader.get_state(KEY) is None
+            assert await reader.get_data(KEY) == {}
+        finally:
+            await expired.close()
+            await reader.close()
+
+    asyncio.run(run())
+
+
+def test_unwritten_changes_are_read_from_memory(tmp_path):
+    path = str(tmp_path / "fsm_state.db")
+    release = threading.Event()
+
+    async def run():
+        storage, other = k.SqliteStorage(path, flush_interval=1), k.SqliteStorage(path)
+        write = storage._write
+
+        def slow_write(batch):
+            release.wait(5)
+            write(batch)
+
+        try:
+            # Ещё в очереди: этот процесс видит изменение, другой — нет
+            await storage.set_state(KEY, "SearchStates:waiting_for_query")
+            assert await storage.get_state(KEY) == "SearchStates:waiting_for_query"
+            assert await other.get_state(KEY) is None
+
+            # Пишется прямо сейчас: чтение берёт пакет flushing, не дожидаясь записи
+            storage._write = slow_write
+            flush = asyncio.create_task(storage.flush())
+            await asyncio.sleep(0.05)
+            assert storage.pending == {} and storage.flushing
+            assert await asyncio.wait_for(storage.get_state(KEY), 1) == "SearchStates:waiting_for_query"
+            release.set()
+            await flush
+            assert storage.flushing == {}
+            assert await other.get_state(KEY) == "SearchStates:waiting_for_query"
+        finally:
+            release.set()
+            await storage.close()
+            await other.close()
+
+    asyncio.run(run())
+
+
+def test_failed_flush_is_requeued(tmp_path):
+    path = str(tmp_path / "fsm_state.db")
+
+    async def run():
+        storage, other = k.SqliteStorage(path, flush_interval=1), k.SqliteStorage(path)
+        write = storage._write
+        failures = []
+
+        def failing_write(batch):
+            failures.append(dict(batch))
+            raise k.sqlite3.OperationalError("database is locked")
+
+        try:
+            await storage.set_state(KEY, "SearchStates:waiting_for_query")
+            await storage.set_data(OTHER_KEY, {"page": 1})
+            storage._write = failing_write
+            await storage.flush()
+            assert len(failures) == 1
+            # Изменения вернулись в очередь и по-прежнему видны при чтении
+            assert set(storage.pending) == set(failures[0])
+            assert await storage.get_data(OTHER_KEY) == {"page": 1}
+
+            # Новое изменение заменяет вернувшееся в очередь, следующая запись проходит
+            await storage.set_data(OTHER_KEY, {"page": 2})
+            storage._write = write
+            await storage.flush()
+            assert storage.pending == {}
+            assert await other.get_state(KEY) == "SearchStates:waiting_for_query"
+            assert await other.get_data(OTHER_KEY) == {"page": 2}
+        finally:
+            await storage.close()
+            await other.close()
+
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import asyncio
+
+import komikshub_bot as k
+
+from conftest import baseline_database
+
+
+def fts_tables(connection):
+    return {name for name, in connection.execute(
+        "SELECT name FROM sqlite_master WHERE name LIKE 'characters_fts%' AND type IN ('table', 'trigger')"
+    )}
+
+
+def test_short_queries_fold_cyrillic_case(database):
+    row = ("Спаун Чернокнижник", "Image", "Spawn Universe", "Антигерой", "Ад", "https://t.me/p/1", "https://example.com/a.jpg")
+    rowid = asyncio.run(database.insert_character(row))
+    engine = k.FtsSearchEngine()
+    engine.rebuild([(rowid, row)])
+
+    async def run(parts):
+        return [found for found, _ in await engine.search(parts, 1000)]
+
+    for parts in (["сп"], ["че"], ["спаун"], ["чернокнижник"], ["ад", "антигерой"]):
+        assert rowid in asyncio.run(run(parts)), parts
+        assert engine.matches(parts, row)
+    # Запрос из коротких слов ищется только в именах; при длинных слова
+    # короче 3 символов не учитываются
+    for parts in (["ад"], ["ад", "бэтмен"], []):
+        assert rowid not in asyncio.run(run(parts)), parts
+        assert not engine.matches(parts, row)
+
+
+def test_short_queries_stop_at_limit_and_follow_catalog():
+    engine = k.FtsSearchEngine()
+    engine.rebuild([(rowid, (f"Спаун {rowid}",)) for rowid in range(1, 11)])
+    engine.remove(2)
+    engine.add(11, ("Спаун-2",))
+
+    assert asyncio.run(engine.search(["сп"], 3)) == [(1, 0.0), (3, 0.0), (4, 0.0)]
+    assert [rowid for rowid, _ in asyncio.run(engine.search(["-2"], 10))] == [11]
+
+
+def test_fts_is_created_once_trigram_becomes_available(tmp_path):
+    connection = baseline_database(str(tmp_path / "baseline.db"))
+    k.migrate(connection)
+    # База, мигрированная на SQLite без триграмм: версия уже 2+, FTS-таблицы нет
+    for event in ("insert", "delete", "update"):
+        connection.execute(f"DROP TRIGGER characters_fts_{event}")
+    connection.execute("DROP TABLE characters_fts")
+    assert not fts_tables(connection)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+
+    k.migrate(connection)
+
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == version
+    assert {"characters_fts", "characters_fts_insert", "characters_fts_delete", "characters_fts_update"} <= fts_tables(connection)
+    assert connection.execute(
+        "SELECT rowid FROM characters_fts WHERE characters_fts MATCH 'Веном'"
+    ).fetchall() == [(3,)]
+    connection.close()
+
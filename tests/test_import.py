@@ -0,0 +1,69 @@
+import sqlite3
+
+import komikshub_bot as k
+
+from conftest import BASELINE_SCHEMA
+
+HEADER = b"name,publisher,universe,type,description,post_link,art_link\n"
+
+
+def line(name):
+    return f"{name},Marvel,Земля-616,Герой,описание,https://t.me/p/1,https://example.com/a.jpg\n".encode()
+
+
+def catalog_database(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "catalog.db"))
+    connection.execute(BASELINE_SCHEMA)
+    connection.commit()
+    k.migrate(connection)
+    return connection
+
+
+def names(connection):
+    return [name for name, in connection.execute("SELECT name FROM characters ORDER BY id")]
+
+
+def test_bad_encoding_and_json_become_row_errors(tmp_path):
+    connection = catalog_database(tmp_path)
+    csv_path = tmp_path / "import.csv"
+    csv_path.write_bytes(HEADER + line("Паук") + line("Веном").replace("Веном".encode(), b"\xff\xfe") + line("Шторм"))
+    jsonl_path = tmp_path / "import.jsonl"
+    jsonl_path.write_bytes(
+        b'{"name": "\xd0\x91\xd1\x8d\xd1\x82\xd0\xbc\xd0\xb5\xd0\xbd", "art_link": "https://example.com/b.jpg"}\n'
+        b'{"name": "\xc3\x28", "art_link": "https://example.com/c.jpg"}\n'
+        b'{"name": \n'
+    )
+
+    assert k.import_characters_file(connection, str(csv_path), "csv") == (
+        2, [(3, "некорректная кодировка, нужен UTF-8")]
+    )
+    imported, errors = k.import_characters_file(connection, str(jsonl_path), "jsonl")
+    assert imported == 1
+    assert [line_num for line_num, _ in errors] == [2, 3]
+    assert errors[0][1] == "некорректная кодировка, нужен UTF-8"
+    assert names(connection) == ["Паук", "Шторм", "Бэтмен"]
+    connection.close()
+
+
+def test_interrupted_import_keeps_committed_chunks(tmp_path, monkeypatch):
+    connection = catalog_database(tmp_path)
+    path = tmp_path / "import.csv"
+    path.write_bytes(HEADER + b"".join(line(f"Герой {i}") for i in range(1, 6)))
+    validate = k.validate_import_record
+
+    def failing(record):
+        if record["name"] == "Герой 4":
+            raise RuntimeError("диск заполнен")
+        return validate(record)
+
+    monkeypatch.setattr(k, "IMPORT_CHUNK_SIZE", 2)
+    monkeypatch.setattr(k, "validate_import_record", failing)
+
+    imported, errors = k.import_characters_file(connection, str(path), "csv")
+
+    # Первая пачка закоммичена, незаконченная вторая откатана
+    assert imported == 2
+    assert errors == [(5, "импорт остановлен, следующие строки не загружены: диск заполнен")]
+    assert names(connection) == ["Герой 1", "Герой 2"]
+    assert not connection.in_transaction
+    connection.close()
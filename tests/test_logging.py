@@ -0,0 +1,27 @@
+import json
+import logging
+
+import komikshub_bot as k
+
+
+def make_record(msg, *args, **extra):
+    record = logging.LogRecord("komikshub", logging.INFO, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_fields_from_extra_are_separate_json_keys():
+    formatter = k.StructuredFormatter(as_json=True)
+    record = make_record("Пользователь %s: найдено %d", 42, 3, **k.log_fields(user_id=42, query="бэт", found=3))
+    output = json.loads(formatter.format(record))
+    assert output["msg"] == "Пользователь 42: найдено 3"
+    assert output["user_id"] == 42
+    assert output["query"] == "бэт"
+    assert output["found"] == 3
+
+
+def test_text_format_appends_fields():
+    formatter = k.StructuredFormatter(as_json=False)
+    record = make_record("Персонажей в базе: %d", 7, **k.log_fields(characters=7))
+    assert formatter.format(record).endswith("Персонажей в базе: 7 characters=7")
+
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+import komikshub_bot as k
+
+
+def sample(text, line_start):
+    return [line for line in text.splitlines() if line.startswith(line_start)]
+
+
+def test_merged_sums_counters_and_histograms():
+    own, other = k.Metrics(), k.Metrics()
+    for metrics in (own, other):
+        metrics.describe("updates_total", "counter", "Апдейты")
+        metrics.inc("updates_total", type="message")
+        metrics.observe("update_seconds", 0.003, type="message")
+    other.inc("updates_total", 4, type="message")
+    other.inc("updates_total", type="callback_query")
+    other.observe("update_seconds", 2.0, type="message")
+
+    text = own.merged([json.loads(json.dumps(other.dump()))]).render()
+
+    assert 'komikshub_updates_total{type="message"} 6' in text
+    assert 'komikshub_updates_total{type="callback_query"} 1' in text
+    assert 'komikshub_update_seconds_bucket{type="message",le="0.005"} 2' in text
+    assert 'komikshub_update_seconds_bucket{type="message",le="2.5"} 3' in text
+    assert 'komikshub_update_seconds_count{type="message"} 3' in text
+    # Собственные значения не меняются при сложении
+    assert own.counters[("updates_total", (("type", "message"),))] == 1
+
+
+def test_every_worker_reports_the_total(tmp_path):
+    first, second = k.SharedMetrics(str(tmp_path), 0), k.SharedMetrics(str(tmp_path), 1)
+    name = "test_shared_total"
+
+    async def run():
+        k.metrics.inc(name, 3)
+        await first.save()
+        # Второй воркер видит снимок первого плюс свой (тот же процесс — тот же
+        # объект metrics, поэтому ожидается удвоение)
+        totals = [sample(await second.render(), f"komikshub_{name} ")]
+        k.metrics.inc(name, 2)
+        totals.append(sample(await second.render(), f"komikshub_{name} "))
+        await first.save()
+        totals.append(sample(await second.render(), f"komikshub_{name} "))
+        return totals
+
+    assert asyncio.run(run()) == [[f"komikshub_{name} 6"], [f"komikshub_{name} 8"], [f"komikshub_{name} 10"]]
+    # Свой файл не суммируется дважды: 5 своих + 5 из снимка второго
+    assert sample(asyncio.run(first.render()), f"komikshub_{name} ") == [f"komikshub_{name} 10"]
@@ -0,0 +1,47 @@
+import komikshub_bot as k
+
+from conftest import baseline_database, row
+
+
+def schema(connection):
+    return connection.execute("SELECT type, name, sql FROM sqlite_master ORDER BY type, name").fetchall()
+
+
+def test_baseline_database_is_upgraded_with_rowids_and_indexes(tmp_path):
+    connection = baseline_database(str(tmp_path / "baseline.db"))
+    rowids = connection.execute("SELECT rowid, name FROM characters ORDER BY rowid").fetchall()
+
+    k.migrate(connection)
+
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == len(k.MIGRATIONS)
+    assert connection.execute("SELECT id, name FROM characters ORDER BY id").fetchall() == rowids
+    assert rowids == [(1, "Паук"), (3, "Веном"), (4, "Джокер")]
+    columns = connection.execute("PRAGMA table_info(characters)").fetchall()
+    assert [(column[1], column[5]) for column in columns][0] == ("id", 1)
+    indexes = {index[1] for index in connection.execute("PRAGMA index_list(characters)")}
+    assert {"idx_characters_name", "idx_characters_publisher", "idx_characters_universe"} <= indexes
+    assert connection.execute(
+        "SELECT name FROM characters INDEXED BY idx_characters_publisher WHERE publisher = 'DC'"
+    ).fetchall() == [("Джокер",)]
+
+    # Новые записи получают id после старых
+    connection.execute(f"INSERT INTO characters ({k.CHARACTER_FIELDS}) VALUES (?, ?, ?, ?, ?, ?, ?)", row("Шторм"))
+    assert connection.execute("SELECT id FROM characters WHERE name = 'Шторм'").fetchone()[0] == 5
+    connection.close()
+
+
+def test_rerunning_migrate_is_a_noop(tmp_path):
+    connection = baseline_database(str(tmp_path / "baseline.db"))
+    k.migrate(connection)
+    before_schema = schema(connection)
+    before_rows = connection.execute("SELECT * FROM characters ORDER BY id").fetchall()
+    before_version = connection.execute("PRAGMA user_version").fetchone()[0]
+    before_changes = connection.total_changes
+
+    k.migrate(connection)
+
+    assert schema(connection) == before_schema
+    assert connection.execute("SELECT * FROM characters ORDER BY id").fetchall() == before_rows
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == before_version
+    assert connection.total_changes == before_changes
+    connection.close()
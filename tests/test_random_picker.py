@@ -0,0 +1,65 @@
+import komikshub_bot as k
+
+from conftest import row
+
+
+def check_positions(ids):
+    assert len(ids.positions) == len(ids)
+    assert all(ids.ids[position] == rowid for rowid, position in ids.positions.items())
+
+
+def test_id_set_removes_last_and_middle_elements():
+    ids = k.IdSet()
+    for rowid in (10, 20, 30, 40):
+        ids.add(rowid)
+    ids.add(20)
+    assert list(ids.ids) == [10, 20, 30, 40]
+
+    # Последний удаляется без перестановки
+    ids.remove(40)
+    assert list(ids.ids) == [10, 20, 30]
+    check_positions(ids)
+
+    # На место удалённого из середины встаёт последний
+    ids.remove(20)
+    assert list(ids.ids) == [10, 30]
+    check_positions(ids)
+
+    ids.remove(20)
+    ids.remove(10)
+    ids.remove(30)
+    assert len(ids) == 0 and ids.positions == {}
+    assert ids.choice() is None
+
+
+def test_picker_keeps_facets_in_sync():
+    picker = k.RandomPicker()
+    picker.add(1, row("Паук"))
+    picker.add(2, row("Бэтмен", "DC"))
+    picker.add(3, row("Джокер", " dc "))
+    assert set(picker.facets["publisher"]) == {"marvel", "dc"}
+
+    picker.remove(2)
+    assert picker.pick("DC") == 3
+    # Пустой набор значения удаляется
+    picker.remove(3)
+    assert "dc" not in picker.facets["publisher"]
+    assert picker.pick("dc") is None
+
+    # Изменение строки переносит id в новый набор
+    picker.add(1, row("Паук", "Image"))
+    assert "marvel" not in picker.facets["publisher"]
+    assert picker.pick("image") == 1
+    assert picker.pick() == 1
+    check_positions(picker.all_ids)
+
+
+def test_pick_checks_publisher_before_type():
+    picker = k.RandomPicker()
+    picker.add(1, ("Паук", "Герой", "Земля-616", "Злодей", "", "", ""))
+    picker.add(2, ("Веном", "Marvel", "Земля-616", "Герой", "", "", ""))
+    # «герой» — издатель персонажа 1 и тип персонажа 2: сначала издатели
+    assert picker.pick("Герой") == 1
+    assert picker.pick("герой", facet="type") == 2
+    assert picker.pick("злодей") == 1
+    assert picker.pick("нет такого") is None
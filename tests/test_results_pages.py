@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+
+import komikshub_bot as k
+
+
+class MessageStub:
+    def __init__(self, error=None):
+        self.error = error
+        self.edits = []
+
+    async def edit_text(self, text, reply_markup=None):
+        self.edits.append(text)
+        if self.error:
+            raise self.error
+
+
+class CallbackStub:
+    def __init__(self, data, message=None):
+        self.data = data
+        self.message = message or MessageStub()
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+
+def press(data, message=None):
+    callback_query = CallbackStub(data, message)
+    asyncio.run(k.handle_results_page(callback_query))
+    return callback_query
+
+
+def test_malformed_and_expired_payloads_are_answered():
+    asyncio.run(k.result_pages.set("abcd1234", list(range(1, 30))))
+    for data in ("page:", "page:abcd1234", "page:abcd1234:x", "page:abcd1234:1:2", "page:gone0000:1"):
+        callback_query = press(data)
+        assert callback_query.answers == ["Результаты поиска устарели, повтори поиск. 🔍"], data
+        assert callback_query.message.edits == []
+
+
+def test_same_page_twice_is_still_answered():
+    asyncio.run(k.result_pages.set("abcd1234", list(range(1, 30))))
+    assert press("page:abcd1234:1").answers == [None]
+    not_modified = TelegramBadRequest(None, "Bad Request: message is not modified")
+    callback_query = press("page:abcd1234:1", MessageStub(not_modified))
+    assert callback_query.answers == [None]
+    assert len(callback_query.message.edits) == 1
+
+
+def test_other_edit_errors_propagate_after_answer():
+    asyncio.run(k.result_pages.set("abcd1234", list(range(1, 30))))
+    callback_query = CallbackStub("page:abcd1234:0", MessageStub(TelegramBadRequest(None, "Bad Request: message to edit not found")))
+    with pytest.raises(TelegramBadRequest):
+        asyncio.run(k.handle_results_page(callback_query))
+    assert callback_query.answers == [None]
+
+
+def test_pages_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / "fsm_state.db")
+
+    async def run():
+        # Два воркера: у каждого своё хранилище на общем файле
+        first = k.ResultPages(k.SqliteStorage(path), ttl=60)
+        second = k.ResultPages(k.SqliteStorage(path), ttl=60)
+        expired = k.ResultPages(k.SqliteStorage(path), ttl=-1)
+        try:
+            await first.set("0123456789abcdef", [5, 3, 8])
+            await expired.set("fedcba9876543210", [1])
+            return (await second.get("0123456789abcdef"), await second.get("fedcba9876543210"),
+                    await second.get("missing"))
+        finally:
+            for pages in (first, second, expired):
+                await pages.storage.close()
+
+    assert asyncio.run(run()) == ([5, 3, 8], None, None)
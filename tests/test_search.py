@@ -0,0 +1,119 @@
+import asyncio
+import random
+
+from rapidfuzz import fuzz
+
+import komikshub_bot as k
+
+WORDS = ["паук", "человек", "нуар", "бэтмен", "спаун", "marvel", "dc", "image", "spider", "noir",
+         "герой", "злодей", "земля-616", "ultimate", "капитан", "iron", "тёмный", "рыцарь"]
+
+
+def random_row(rng):
+    name = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+    return (name, rng.choice(["Marvel", "DC", "Image"]), rng.choice(WORDS), rng.choice(["Герой", "Злодей"]),
+            "описание", "https://t.me/p/1", "https://example.com/a.jpg")
+
+
+def random_query(rng):
+    word = rng.choice(WORDS)
+    kind = rng.random()
+    if kind < 0.3:
+        return [word[:rng.randint(1, len(word))]]
+    if kind < 0.6:
+        position = rng.randrange(len(word))
+        return [word[:position] + rng.choice("аоxz") + word[position + 1:]]
+    return [word, rng.choice(WORDS)]
+
+
+def brute_force(index, rows, query_parts):
+    matches = []
+    for rowid, row in rows:
+        text = index.combined_text(row)
+        score = max(fuzz.partial_ratio(part, text) for part in query_parts)
+        if score >= index.threshold:
+            matches.append(rowid)
+    return sorted(matches)
+
+
+def test_search_matches_brute_force_partial_ratio():
+    rng = random.Random(7)
+    rows = [(rowid, random_row(rng)) for rowid in range(1, 301)]
+    index = k.SearchIndex(threshold=50)
+    index.rebuild(rows)
+
+    async def run():
+        for _ in range(200):
+            query_parts = random_query(rng)
+            found = await index.search(query_parts, limit=len(rows))
+            assert sorted(rowid for rowid, _ in found) == brute_force(index, rows, query_parts), query_parts
+
+    asyncio.run(run())
+
+
+def test_search_follows_catalog_changes_and_ranks_top_k():
+    index = k.SearchIndex(threshold=50)
+    index.rebuild([(1, ("Человек-паук", "Marvel", "Земля-616", "Герой")),
+                   (2, ("Паук-Нуар", "Marvel", "Marvel Noir", "Герой")),
+                   (3, ("Бэтмен", "DC", "Prime Earth", "Герой"))])
+
+    async def run():
+        assert [rowid for rowid, _ in await index.search(["бэтмен"], limit=1)] == [3]
+        index.remove(3)
+        index.add(4, ("Бэтмен Нуар", "DC", "Elseworlds", "Герой"))
+        found = await index.search(["бэтмен"], limit=10)
+        assert [rowid for rowid, _ in found] == [4]
+        scores = [score for _, score in await index.search(["паук", "нуар"], limit=10)]
+        assert scores == sorted(scores, reverse=True)
+
+    asyncio.run(run())
+
+
+def test_changes_update_snapshot_in_place_order():
+    rng = random.Random(3)
+    index = k.SearchIndex(threshold=50)
+    rows = {rowid: random_row(rng) for rowid in range(1, 51)}
+    index.rebuild(rows.items())
+    for step in range(200):
+        before = index.snapshot
+        frozen = (list(before[0]), list(before[1]))
+        rowid = rng.randint(1, 60)
+        if rng.random() < 0.4:
+            rows.pop(rowid, None)
+            index.remove(rowid)
+        else:
+            rows[rowid] = random_row(rng)
+            index.add(rowid, rows[rowid])
+        # Снимок, отданный в пул, не меняется; новый — в порядке id
+        assert before == frozen
+        assert index.snapshot == (sorted(rows), [index.combined_text(rows[rowid]) for rowid in sorted(rows)])
+
+
+class MessageStub:
+    def __init__(self, text):
+        self.text = text
+        self.from_user = type("User", (), {"id": 1})()
+        self.replies = []
+
+    async def reply(self, text, reply_markup=None):
+        self.replies.append(text)
+
+
+class StateStub:
+    def __init__(self):
+        self.cleared = False
+
+    async def clear(self):
+        self.cleared = True
+
+
+def test_query_without_words_is_not_found():
+    index = k.SearchIndex(threshold=50)
+    index.rebuild([(1, ("Человек-паук", "Marvel", "Земля-616", "Герой"))])
+    assert asyncio.run(index.search([], limit=10)) == []
+
+    for text in ("-", " - -", None):
+        message, state = MessageStub(text), StateStub()
+        asyncio.run(k.handle_search_query(message, state))
+        assert message.replies == ["Персонаж не найден! Попробуй другой запрос. 😎"], text
+        assert state.cleared
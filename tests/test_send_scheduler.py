@@ -0,0 +1,126 @@
+import asyncio
+import multiprocessing
+
+from aiogram.exceptions import TelegramRetryAfter
+
+import komikshub_bot as k
+
+
+def scheduler(limits, **kwargs):
+    settings = {"rate": 1000, "burst": 5, "chat_rate": 0.001, "chat_burst": 3, "group_rate": 0.001, **kwargs}
+    return k.SendScheduler(limits=limits, **settings)
+
+
+async def granted(schedulers, requests, timeout=0.2):
+    async def acquire(scheduler, chat_id, priority):
+        try:
+            await asyncio.wait_for(scheduler.acquire(chat_id, priority), timeout)
+            return chat_id, priority
+        except asyncio.TimeoutError:
+            return None
+
+    try:
+        results = await asyncio.gather(*(acquire(schedulers[worker], chat_id, priority)
+                                         for worker, chat_id, priority in requests))
+    finally:
+        for item in schedulers:
+            item.close()
+    return [result for result in results if result is not None]
+
+
+def test_chat_limit_is_shared_between_workers():
+    limits = k.SendLimits(slots=64)
+    # Два воркера получают сообщения в один чат: вместе не больше chat_burst
+    requests = [(worker, 42, k.SendScheduler.HIGH) for worker in (0, 1) for _ in range(4)]
+    assert len(asyncio.run(granted([scheduler(limits), scheduler(limits)], requests))) == 3
+
+
+def test_broadcast_leaves_reserve_for_replies():
+    limits = k.SendLimits(slots=64)
+    workers = [scheduler(limits, rate=0.001, chat_burst=10), scheduler(limits, rate=0.001, chat_burst=10)]
+    # Рассылка в первом воркере выбирает всё, кроме резерва; ответ во втором его получает
+    broadcast = [(0, chat_id, k.SendScheduler.LOW) for chat_id in range(100, 110)]
+
+    async def run():
+        sent = await granted(workers[:1], broadcast)
+        replies = await granted(workers[1:], [(0, 7, k.SendScheduler.HIGH)] * 2)
+        return sent, replies
+
+    sent, replies = asyncio.run(run())
+    assert len(sent) == 5 - k.SendScheduler.LOW_RESERVE
+    assert replies == [(7, k.SendScheduler.HIGH)]
+
+
+def test_pause_after_429_applies_to_all_workers():
+    limits = k.SendLimits(slots=64)
+    first, second = scheduler(limits), scheduler(limits)
+    first.pause(10)
+    assert asyncio.run(granted([second], [(0, 42, k.SendScheduler.HIGH)])) == []
+
+
+def test_slot_collision_does_not_loosen_group_limit():
+    limits = k.SendLimits(slots=64)
+    group = -100
+    private = next(chat_id for chat_id in range(1, 10000) if limits.slot(chat_id) == limits.slot(group))
+    # Группа выбрала своё ведро; личный чат в том же слоте не пополняет его
+    # со своей скоростью ни для себя, ни для группы
+    workers = [scheduler(limits, chat_rate=100), scheduler(limits, chat_rate=100)]
+    sent = asyncio.run(granted(workers[:1], [(0, group, k.SendScheduler.HIGH)] * 3))
+    assert len(sent) == 3
+    assert asyncio.run(granted(workers[1:], [(0, private, k.SendScheduler.HIGH), (0, group, k.SendScheduler.HIGH)])) == []
+
+
+def test_backoff_after_429_holds_only_that_chat():
+    limits = k.SendLimits(slots=64)
+    first, second = scheduler(limits, chat_rate=100), scheduler(limits, chat_rate=100)
+    first.backoff(42, 10)
+    sent = asyncio.run(granted([second], [(0, 42, k.SendScheduler.HIGH), (0, 43, k.SendScheduler.HIGH)]))
+    assert sent == [(43, k.SendScheduler.HIGH)]
+
+
+class SchedulerStub:
+    def __init__(self):
+        self.calls = []
+
+    async def acquire(self, chat_id, priority):
+        pass
+
+    def backoff(self, chat_id, seconds):
+        self.calls.append(("backoff", chat_id, seconds))
+
+    def pause(self, seconds):
+        self.calls.append(("pause", seconds))
+
+
+def test_repeated_429_pauses_all_sends():
+    stub = SchedulerStub()
+    middleware = k.SendSchedulerMiddleware(stub, max_retries=3)
+    method = type("SendMessage", (), {"chat_id": 42})()
+    responses = [TelegramRetryAfter(method, "Too Many Requests", 5), TelegramRetryAfter(method, "Too Many Requests", 7), "ok"]
+
+    async def make_request(bot, method):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert asyncio.run(middleware(make_request, None, method)) == "ok"
+    assert stub.calls == [("backoff", 42, 5), ("pause", 7)]
+
+
+def take_in_worker(limits, chat_id, count):
+    bucket = k.TokenBucket(limits.buckets, limits.slot(chat_id), 0.001, 3)
+    with limits.lock:
+        for _ in range(count):
+            bucket.delay(k.time.monotonic())
+            bucket.take()
+
+
+def test_limits_are_shared_with_spawned_workers():
+    limits = k.SendLimits(slots=64)
+    process = multiprocessing.get_context("spawn").Process(target=take_in_worker, args=(limits, 42, 2))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+    sent = asyncio.run(granted([scheduler(limits)], [(0, 42, k.SendScheduler.HIGH)] * 3))
+    assert len(sent) == 1
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sqlite3
+
+import pytest
+from aiohttp import web
+
+import komikshub_bot as k
+
+from conftest import BASELINE_SCHEMA, row
+
+
+def make_database(path, schema, rows):
+    connection = sqlite3.connect(path)
+    connection.execute(schema)
+    connection.executemany(f"INSERT INTO characters VALUES ({', '.join('?' * len(rows[0]))})", rows)
+    connection.commit()
+    connection.close()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Облако: отдаёт файл с ETag и отвечает 304 на If-None-Match
+class CloudStub:
+    def __init__(self):
+        self.body = b""
+        self.etag = '"v0"'
+        self.requests = []
+
+    def publish(self, body, etag):
+        self.body = body
+        self.etag = etag
+
+    async def handle(self, request):
+        self.requests.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304)
+        return web.Response(body=self.body, headers={"ETag": self.etag})
+
+
+async def serve(cloud):
+    app = web.Application()
+    app.router.add_get("/db", cloud.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/db"
+
+
+def test_conditional_sync_and_rejected_schema(database, tmp_path):
+    cloud = CloudStub()
+    cloud.publish(make_database(str(tmp_path / "v1.db"), BASELINE_SCHEMA, [row("Паук"), row("Нуар")]), '"v1"')
+
+    async def run():
+        runner, url = await serve(cloud)
+        try:
+            sync = k.DatabaseSync(url, database.path)
+            sync.reset()
+            assert await sync.sync() is True
+            assert await database.count_characters() == 2
+            assert await database.character_by_id(1) == row("Паук")
+
+            # Файл не изменился: условный запрос и 304
+            assert await sync.sync() is False
+            assert cloud.requests[-1].get("If-None-Match") == '"v1"'
+
+            # Несовместимая схема отклоняется до подмены, локальная база цела
+            cloud.publish(make_database(str(tmp_path / "v2.db"), "CREATE TABLE characters (name TEXT, publisher TEXT)",
+                                        [("Сломанный", "DC")]), '"v2"')
+            assert await sync.sync() is False
+            assert await asyncio.wait_for(database.count_characters(), 5) == 2
+            assert not [name for name in os.listdir(os.path.dirname(database.path)) if name.startswith(".download-")]
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def test_failed_swap_restores_previous_database(database, tmp_path, monkeypatch):
+    async def run():
+        before = await database.count_characters()
+        new_path = str(tmp_path / "new.db")
+        make_database(new_path, BASELINE_SCHEMA, [row("Новый")])
+        k.DatabaseSync._check_database(new_path)
+
+        original = k.Database._open_connections
+        calls = []
+
+        def fail_once(self):
+            calls.append(1)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("disk I/O error")
+            return original(self)
+
+        monkeypatch.setattr(k.Database, "_open_connections", fail_once)
+        with pytest.raises(sqlite3.OperationalError):
+            await database.replace_file(new_path)
+        monkeypatch.setattr(k.Database, "_open_connections", original)
+
+        assert await asyncio.wait_for(database.count_characters(), 5) == before
+        assert not os.path.exists(database.path + ".bak")
+
+    asyncio.run(run())
@@ -0,0 +1,83 @@
+import asyncio
+import sqlite3
+
+import komikshub_bot as k
+
+from conftest import row
+
+
+# Другой воркер пишет в тот же файл своим соединением
+def other_worker(path, *statements):
+    connection = sqlite3.connect(path)
+    with connection:
+        for sql, params in statements:
+            connection.execute(sql, params)
+    connection.close()
+
+
+def insert(name):
+    return f"INSERT INTO characters ({k.CHARACTER_FIELDS}) VALUES (?, ?, ?, ?, ?, ?, ?)", row(name)
+
+
+def test_changes_from_other_workers_are_applied_by_id(database, monkeypatch):
+    reloads = []
+    reload = k.catalog.reload
+
+    async def counting_reload(fetch_rows):
+        reloads.append(True)
+        await reload(fetch_rows)
+
+    monkeypatch.setattr(k.catalog, "reload", counting_reload)
+
+    async def watch(version):
+        task = asyncio.create_task(k.watch_catalog(version, 0.01, max_changes=10))
+        await asyncio.sleep(0.3)
+        task.cancel()
+
+    async def run():
+        await k.catalog.reload(k.db.all_characters)
+        reloads.clear()
+        version = await k.db.catalog_version()
+
+        # Своё изменение: строка уже в каталоге, применять нечего
+        own = await k.db.insert_character(row("Свой"))
+        k.catalog.add(own, row("Свой"))
+        other_worker(database.path, insert("Чужой"), ("DELETE FROM characters WHERE id = ?", (own,)))
+        await watch(version)
+        names = {character[0] for character in k.catalog.rows.values()}
+        assert "Чужой" in names and "Свой" not in names
+        assert reloads == []
+        assert k.catalog.get(k.catalog.id_by_name("Чужой")) == row("Чужой")
+
+        # Изменений больше max_changes или журнал неполон — полная перезагрузка в потоке
+        version = await k.db.catalog_version()
+        other_worker(database.path, *[insert(f"Массовый {i}") for i in range(11)])
+        await watch(version)
+        assert len(reloads) == 1
+        version = await k.db.catalog_version()
+        other_worker(database.path, insert("После замены"), ("DELETE FROM catalog_changes", ()))
+        await watch(version)
+        assert len(reloads) == 2
+        assert k.catalog.id_by_name("После замены") is not None
+        assert len(k.catalog) == await k.db.count_characters()
+
+    asyncio.run(run())
+
+
+def test_reload_keeps_changes_made_while_building(database):
+    async def run():
+        added = []
+
+        async def slow_rows():
+            rows = await k.db.all_characters()
+            # Пока строится снимок, обработчик в этом процессе добавил персонажа
+            rowid = await k.db.insert_character(row("Во время перезагрузки"))
+            k.catalog.add(rowid, row("Во время перезагрузки"))
+            added.append(rowid)
+            return rows
+
+        await k.catalog.reload(slow_rows)
+        assert k.catalog.get(added[0]) == row("Во время перезагрузки")
+        assert k.random_picker.values.get(added[0]) is not None
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+import komikshub_bot as k
+
+SECRET = "local-test-secret"
+
+
+def message_update(update_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 376742720, "type": "private"},
+            "from": {"id": 376742720, "is_bot": False, "first_name": "admin"},
+            "text": text,
+        },
+    }
+
+
+def test_webhook_rejects_posts_without_secret():
+    dispatcher = Dispatcher()
+    received = []
+
+    @dispatcher.message()
+    async def record(message):
+        received.append(message.text)
+
+    async def run():
+        bot = Bot(token=os.environ["TELEGRAM_TOKEN"])
+        app = web.Application()
+        k.BoundedRequestHandler(dispatcher, bot, max_in_flight=4, max_pending=10,
+                                secret_token=SECRET).register(app, path="/webhook")
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/webhook"
+        try:
+            async with aiohttp.ClientSession() as session:
+                statuses = []
+                for update_id, headers in enumerate([
+                    {},
+                    {"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+                    {"X-Telegram-Bot-Api-Secret-Token": SECRET},
+                ], start=1):
+                    async with session.post(url, json=message_update(update_id, f"/import {update_id}"),
+                                            headers=headers) as response:
+                        statuses.append(response.status)
+            # Принятый апдейт обрабатывается в фоне
+            for _ in range(50):
+                if received:
+                    break
+                await asyncio.sleep(0.02)
+            return statuses
+        finally:
+            await runner.cleanup()
+            await bot.session.close()
+
+    assert asyncio.run(run()) == [401, 401, 200]
+    assert received == ["/import 3"]
+
+
+def test_webhook_mode_generates_secret_when_unset():
+    env = {**os.environ, "BOT_MODE": "webhook"}
+    env.pop("WEBHOOK_SECRET", None)
+    script = "import komikshub_bot as k; print(k.WEBHOOK_SECRET == __import__('os').environ['WEBHOOK_SECRET'], len(k.WEBHOOK_SECRET))"
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True).stdout.split()
+    assert output[0] == "True"
+    assert int(output[1]) >= 32